@@ -5,7 +5,13 @@ from __future__ import print_function
 import sys
 sys.path.append('xlnet') # walkaround due to submodule absolute import...
 
+import bisect
 import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import multiprocessing
 import os
 import os.path
 import json
@@ -16,6 +22,11 @@ import tensorflow as tf
 import numpy as np
 import sentencepiece as sp
 
+from tool.example_store import ExampleStore
+from tool.feature_cache import FeatureCache
+from tool.json_stream import JsonStreamReader
+from tool.paragraph_store import ParagraphStore
+from tool.tfrecord_writer import TFRecordWriter, concat_features, encode_batched_example, encode_bytes_feature, encode_float_feature, encode_int_feature
 from xlnet import xlnet
 import function_builder
 import prepro_utils
@@ -50,7 +61,22 @@ flags.DEFINE_float("init_range", default=0.1, help="Initialization std when init
 flags.DEFINE_bool("init_global_vars", default=False, help="If true, init all global vars. If false, init trainable vars only.")
 
 flags.DEFINE_bool("lower_case", default=False, help="Enable lower case nor not.")
+flags.DEFINE_integer("tokenizer_cache_size", default=65536, help="Max number of tokenized questions and answers cached by tokenizer.")
+flags.DEFINE_integer("tokenizer_threads", default=1, help="Number of threads used by batch tokenization.")
 flags.DEFINE_integer("doc_stride", default=128, help="Doc stride")
+flags.DEFINE_bool("fast_align", default=False, help="Align raw and tokenized paragraph in linear time, fall back to LCS on mismatch. Whitespace may be aligned differently from LCS, so char offsets of some features can change.")
+flags.DEFINE_integer("paragraph_cache_size", default=1024, help="Max number of converted paragraphs kept in memory for reuse.")
+flags.DEFINE_string("paragraph_store_dir", default=None, help="On-disk store of converted paragraphs, can be shared by all runners. If None, no store is used.")
+flags.DEFINE_string("example_store_dir", default=None, help="On-disk store of processed examples keyed by data file and pipeline options. If None, no store is used.")
+flags.DEFINE_integer("num_workers", default=1, help="Number of worker processes for feature conversion, 1 means serial conversion.")
+flags.DEFINE_integer("shard_size", default=10000, help="Number of training examples converted and saved per TFRecord shard.")
+flags.DEFINE_integer("num_predict_shards", default=4, help="Number of TFRecord shards prediction features are saved to.")
+flags.DEFINE_enum("record_compression", default="", enum_values=["", "GZIP", "ZLIB"], help="Compression type of TFRecord files.")
+flags.DEFINE_integer("features_per_record", default=1, help="Number of training features pre-batched into one TFRecord example, records are parsed in batches if larger than 1.")
+flags.DEFINE_integer("pack_size", default=1, help="Max number of training features packed into one sequence, packed features are kept from attending to each other by perm_mask.")
+flags.DEFINE_bool("compact_tfrecord", default=False, help="Save unpadded input ids with paragraph and query lengths to TFRecord, padding and masks are rebuilt in graph.")
+flags.DEFINE_string("feature_cache_dir", default=None, help="Directory of cached features keyed by data and preprocessing options. If None, `<output_dir>/feature_cache` is used.")
+flags.DEFINE_float("feature_cache_size", default=50.0, help="Disk budget of feature cache in GB, least recently used features are evicted beyond it.")
 flags.DEFINE_integer("max_seq_length", default=512, help="Max sequence length")
 flags.DEFINE_integer("max_query_length", default=64, help="Max query length")
 flags.DEFINE_integer("max_answer_length", default=64, help="Max answer length")
@@ -61,6 +87,10 @@ flags.DEFINE_integer("train_steps", default=8000, help="Number of training steps
 flags.DEFINE_integer("warmup_steps", default=0, help="number of warmup steps")
 flags.DEFINE_integer("max_save", default=5, help="Max number of checkpoints to save. Use 0 to save all.")
 flags.DEFINE_integer("save_steps", default=1000, help="Save the model for every save_steps. If None, not to save any model.")
+flags.DEFINE_bool("batch_parse", default=False, help="Parse batches of serialized records with a single op instead of parsing records one by one.")
+flags.DEFINE_integer("prefetch_memory", default=256, help="Host memory budget (in MB) of batches prefetched by input pipeline.")
+flags.DEFINE_list("bucket_boundaries", default=None, help="Sequence length boundaries of buckets, examples are batched by true length and padded to bucket boundary (not for TPU).")
+flags.DEFINE_bool("time_major", default=False, help="Feed time major [l,b] inputs to XLNet and build output heads on [l,b,h] sequence output, so that activations are not transposed (not for TPU).")
 flags.DEFINE_integer("shuffle_buffer", default=2048, help="Buffer size used for shuffle.")
 
 flags.DEFINE_integer("n_best_size", default=5, help="n best size for predictions")
@@ -122,6 +152,23 @@ class InputExample(object):
 
 class InputFeatures(object):
     """A single SQuAD feature."""
+    __slots__ = [
+        "unique_id",
+        "qas_id",
+        "doc_idx",
+        "token2char_raw_start_index",
+        "token2char_raw_end_index",
+        "token2doc_index",
+        "input_ids",
+        "input_mask",
+        "p_mask",
+        "segment_ids",
+        "cls_index",
+        "para_length",
+        "start_position",
+        "end_position",
+        "is_impossible"]
+    
     def __init__(self,
                  unique_id,
                  qas_id,
@@ -174,37 +221,128 @@ class SquadPipeline(object):
     """Pipeline for SQuAD dataset."""
     def __init__(self,
                  data_dir,
-                 task_name):
+                 task_name,
+                 example_store=None):
         self.data_dir = data_dir
         self.task_name = task_name
+        self.example_store = example_store
+    
+    def get_train_data_path(self):
+        """Gets path of the data file for the train set."""
+        return self._get_data_path("train")
     
     def get_train_examples(self):
-        """Gets a collection of `InputExample`s for the train set."""
-        data_path = os.path.join(self.data_dir, "train-{0}.json".format(self.task_name))
-        data_list = self._read_json(data_path)
-        example_list = self._get_example(data_list, True)
-        return example_list
+        """Gets a collection of `InputExample`s for the train set, processed examples are reused if example store is used."""
+        return self._get_stored_examples("train", self.iter_train_examples)
+    
+    def iter_train_examples(self):
+        """Iterates over `InputExample`s for the train set, data file is read incrementally."""
+        data_list = self._read_json(self.get_train_data_path())
+        for data in data_list:
+            for example in self._get_train_unit_examples(data):
+                yield example
+    
+    def iter_train_units(self):
+        """Iterates over units of the train set, each unit is a tuple of unit id, content hash and lazily generated `InputExample`s."""
+        data_list = self._read_json(self.get_train_data_path())
+        for data in data_list:
+            unit_hash = self._get_unit_hash(data)
+            yield self._get_unit_id(data, unit_hash), unit_hash, self._get_train_unit_examples(data)
+    
+    def get_dev_data_path(self):
+        """Gets path of the data file for the dev set."""
+        return self._get_data_path("dev")
     
     def get_dev_examples(self):
-        """Gets a collection of `InputExample`s for the dev set."""
-        data_path = os.path.join(self.data_dir, "dev-{0}.json".format(self.task_name))
-        data_list = self._read_json(data_path)
-        example_list = self._get_example(data_list, False)
-        return example_list
+        """Gets a collection of `InputExample`s for the dev set, processed examples are reused if example store is used."""
+        return self._get_stored_examples("dev", self.iter_dev_examples)
+    
+    def iter_dev_examples(self):
+        """Iterates over `InputExample`s for the dev set, data file is read incrementally."""
+        data_list = self._read_json(self.get_dev_data_path())
+        for example in self._get_example(data_list, False):
+            yield example
+    
+    def _get_train_unit_examples(self,
+                                 data):
+        for example in self._get_example([data], True):
+            yield example
+    
+    def _get_unit_hash(self,
+                       data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    def _get_unit_id(self,
+                     data,
+                     unit_hash):
+        # Article titles are not unique, so unit is identified by a hash of its question ids, or by its content if it has no question
+        qas_ids = [qa["id"] for paragraph in data["paragraphs"] for qa in paragraph["qas"]]
+        if not qas_ids:
+            return unit_hash
+        
+        return hashlib.sha1("|".join(qas_ids).encode("utf-8")).hexdigest()
+    
+    def _get_stored_examples(self,
+                             data_split,
+                             example_fn):
+        if self.example_store is None:
+            return list(example_fn())
+        
+        data_path = self._get_data_path(data_split)
+        store_options = {"task_name": self.task_name, "data_split": data_split}
+        columns = self.example_store.load(data_path, store_options)
+        if columns is not None:
+            return self._get_column_examples(columns)
+        
+        examples = list(example_fn())
+        self.example_store.save(data_path, store_options, self._get_example_columns(examples))
+        return examples
+    
+    def _get_example_columns(self,
+                             examples):
+        return [
+            ("qas_id", "text", [example.qas_id for example in examples]),
+            ("question_text", "text", [example.question_text for example in examples]),
+            ("paragraph_text", "text", [example.paragraph_text for example in examples]),
+            ("orig_answer_text", "text", [example.orig_answer_text for example in examples]),
+            ("start_position", "json", [example.start_position for example in examples]),
+            ("is_impossible", "bool", [example.is_impossible for example in examples])
+        ]
+    
+    def _get_column_examples(self,
+                             columns):
+        examples = []
+        for idx in range(len(columns["qas_id"])):
+            examples.append(InputExample(
+                qas_id=columns["qas_id"][idx],
+                question_text=columns["question_text"][idx],
+                paragraph_text=columns["paragraph_text"][idx],
+                orig_answer_text=columns["orig_answer_text"][idx],
+                start_position=columns["start_position"][idx],
+                is_impossible=columns["is_impossible"][idx]))
+        
+        return examples
+    
+    def _get_data_path(self,
+                       data_split):
+        """Get data file path of a split. Gzipped file is used if only `<data_path>.gz` exists."""
+        data_path = os.path.join(self.data_dir, "{0}-{1}.json".format(data_split, self.task_name))
+        if not os.path.exists(data_path) and os.path.exists(data_path + ".gz"):
+            data_path = data_path + ".gz"
+        
+        return data_path
     
     def _read_json(self,
                    data_path):
+        """Read data list lazily, one entry at a time."""
         if os.path.exists(data_path):
-            with open(data_path, "r") as file:
-                data_list = json.load(file)["data"]
-                return data_list
+            return iter(JsonStreamReader(data_path))
         else:
             raise FileNotFoundError("data path not found: {0}".format(data_path))
     
     def _get_example(self,
                      data_list,
                      is_training):
-        examples = []
         for entry in data_list:
             for paragraph in entry["paragraphs"]:
                 paragraph_text = paragraph["context"]
@@ -237,19 +375,28 @@ class SquadPipeline(object):
                         start_position=start_position,
                         is_impossible=is_impossible)
                     
-                    examples.append(example)
-        
-        return examples
+                    yield example
 
 class XLNetTokenizer(object):
     """Default text tokenizer for XLNet"""
     def __init__(self,
                  sp_model_file,
-                 lower_case=False):
+                 lower_case=False,
+                 cache_size=65536,
+                 num_threads=1):
         """Construct XLNet tokenizer"""
         self.sp_processor = sp.SentencePieceProcessor()
         self.sp_processor.Load(sp_model_file)
         self.lower_case = lower_case
+        self.num_threads = num_threads
+        self.id_vocab = [self.sp_processor.IdToPiece(id) for id in range(self.sp_processor.GetPieceSize())]
+        self.piece_vocab = {piece: id for id, piece in enumerate(self.id_vocab)}
+        self.unk_id = self.sp_processor.unk_id()
+        self.tokenize_cached = functools.lru_cache(maxsize=cache_size)(self._tokenize)
+    
+    def _tokenize(self,
+                  text):
+        return tuple(self.tokenize(text))
     
     def tokenize(self,
                  text):
@@ -258,6 +405,22 @@ class XLNetTokenizer(object):
         tokenized_pieces = prepro_utils.encode_pieces(self.sp_processor, processed_text, return_unicode=False)
         return tokenized_pieces
     
+    def tokenize_batch(self,
+                       texts):
+        """Tokenize a batch of texts for XLNet, unique texts are tokenized across thread pool and results are cached"""
+        unique_texts = list(collections.OrderedDict.fromkeys(texts))
+        if self.num_threads > 1 and len(unique_texts) > 1:
+            chunk_size = (len(unique_texts) + self.num_threads - 1) // self.num_threads
+            text_chunks = [unique_texts[idx:idx+chunk_size] for idx in range(0, len(unique_texts), chunk_size)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                piece_chunks = executor.map(lambda text_chunk: [self.tokenize_cached(text) for text in text_chunk], text_chunks)
+                unique_pieces = [pieces for piece_chunk in piece_chunks for pieces in piece_chunk]
+        else:
+            unique_pieces = [self.tokenize_cached(text) for text in unique_texts]
+        
+        text_pieces = dict(zip(unique_texts, unique_pieces))
+        return [list(text_pieces[text]) for text in texts]
+    
     def encode(self,
                text):
         """Encode text for XLNet"""
@@ -265,33 +428,52 @@ class XLNetTokenizer(object):
         encoded_ids = prepro_utils.encode_ids(self.sp_processor, processed_text)
         return encoded_ids
     
+    def encode_ids_batch(self,
+                         texts):
+        """Encode a batch of texts for XLNet"""
+        return [self.tokens_to_ids(tokens) for tokens in self.tokenize_batch(texts)]
+    
     def token_to_id(self,
                     token):
         """Convert token to id for XLNet"""
-        return self.sp_processor.PieceToId(token)
+        return self.piece_vocab.get(token, self.unk_id)
     
     def id_to_token(self,
                     id):
         """Convert id to token for XLNet"""
-        return self.sp_processor.IdToPiece(id)
+        return self.id_vocab[id]
     
     def tokens_to_ids(self,
                       tokens):
         """Convert tokens to ids for XLNet"""
-        return [self.sp_processor.PieceToId(token) for token in tokens]
+        piece_vocab = self.piece_vocab
+        unk_id = self.unk_id
+        return [piece_vocab.get(token, unk_id) for token in tokens]
     
     def ids_to_tokens(self,
                       ids):
         """Convert ids to tokens for XLNet"""
-        return [self.sp_processor.IdToPiece(id) for id in ids]
+        id_vocab = self.id_vocab
+        return [id_vocab[id] for id in ids]
 
 class XLNetExampleProcessor(object):
     """Default example processor for XLNet"""
+    # Conversion context of worker processes, only set in workers of parallel conversion
+    shard_context = None
+    
     def __init__(self,
                  max_seq_length,
                  max_query_length,
                  doc_stride,
-                 tokenizer):
+                 tokenizer,
+                 fast_align=False,
+                 paragraph_cache_size=1024,
+                 paragraph_store=None,
+                 num_workers=1,
+                 compact_tfrecord=False,
+                 record_compression="",
+                 features_per_record=1,
+                 pack_size=1):
         """Construct XLNet example processor"""
         self.special_vocab_list = ["<unk>", "<s>", "</s>", "<cls>", "<sep>", "<pad>", "<mask>", "<eod>", "<eop>"]
         self.special_vocab_map = {}
@@ -307,121 +489,203 @@ class XLNetExampleProcessor(object):
         self.max_query_length = max_query_length
         self.doc_stride = doc_stride
         self.tokenizer = tokenizer
+        self.fast_align = fast_align
+        self.paragraph_cache_size = paragraph_cache_size
+        self.paragraph_cache = collections.OrderedDict()
+        self.paragraph_store = paragraph_store
+        self.num_workers = num_workers
+        self.compact_tfrecord = compact_tfrecord
+        self.record_compression = record_compression
+        self.features_per_record = features_per_record
+        self.pack_size = pack_size
         self.unique_id = 1000000000
     
+    def _generate_raw_char_map(self,
+                               para_text):
+        """Generate normalized char map for raw paragraph"""
+        raw_char_map = {}
+        for raw_char in set(para_text):
+            raw_char_map[raw_char] = prepro_utils.preprocess_text(raw_char, lower=self.tokenizer.lower_case, remove_space=False)
+        
+        return raw_char_map
+    
+    def _generate_fast_mapping(self,
+                               para_text,
+                               tokenized_para_text,
+                               raw_char_map,
+                               N,
+                               M):
+        """Generate char mapping for raw and tokenized paragraph in linear time
+        
+        tokenized paragraph mostly differs from raw paragraph by collapsed or inserted whitespace,
+        so chars are paired greedily under the same char normalization used by LCS matching.
+        Returns None if any other difference is found, e.g. replaced quotes or expanded chars.
+        Equally long alignments are not broken the way LCS backtracking breaks them, e.g. raw '  |\na' against
+        tokenized ' | a' pairs '|' here but the second space in LCS, so the mapping may differ from LCS mapping
+        """
+        raw2tokenized_char_index = [-1] * N
+        tokenized2raw_char_index = [-1] * M
+        num_match = 0
+        i, j = 0, 0
+        while i < N and j < M:
+            raw_char = raw_char_map[para_text[i]]
+            if raw_char == tokenized_para_text[j]:
+                raw2tokenized_char_index[i] = j
+                tokenized2raw_char_index[j] = i
+                num_match += 1
+                i, j = i + 1, j + 1
+            elif not raw_char or para_text[i].isspace():
+                i = i + 1
+            elif tokenized_para_text[j] == ' ':
+                j = j + 1
+            else:
+                return None
+        
+        if any(raw_char_map[raw_char] and not raw_char.isspace() for raw_char in para_text[i:]):
+            return None
+        
+        if tokenized_para_text[j:].strip(' '):
+            return None
+        
+        mismatch = num_match < 0.8 * N
+        return np.array(raw2tokenized_char_index, dtype=np.int64), np.array(tokenized2raw_char_index, dtype=np.int64), mismatch
+    
     def _generate_match_mapping(self,
                                 para_text,
                                 tokenized_para_text,
+                                raw_char_map,
                                 N,
-                                M,
-                                max_N,
-                                max_M):
+                                M):
         """Generate match mapping for raw and tokenized paragraph"""
-        def _lcs_match(para_text,
-                       tokenized_para_text,
+        def _lcs_match(raw_char_codes,
+                       tokenized_char_codes,
                        N,
                        M,
-                       max_N,
-                       max_M,
                        max_dist):
             """longest common sub-sequence
             
             f[i, j] = max(f[i - 1, j], f[i, j - 1], f[i - 1, j - 1] + match(i, j))
             
             unlike standard LCS, this is specifically optimized for the setting
-            because the mismatch between sentence pieces and original text will be small
+            because the mismatch between sentence pieces and original text will be small,
+            so only the diagonal band i - max_dist <= j < i + max_dist is computed. The
+            back-pointer of (i, j) is stored at g[i, j - i + max_dist] with -1 for unset cells,
+            and f[i, j - 1] is folded into a running max since f is non-decreasing along j
             """
-            f = np.zeros((max_N, max_M), dtype=np.float32)
-            g = {}
+            band_size = 2 * max_dist
+            f_prev = np.zeros(band_size + 1, dtype=np.int32)
+            g = np.full((N, band_size), -1, dtype=np.int8)
             
             for i in range(N):
-                for j in range(i - max_dist, i + max_dist):
-                    if j >= M or j < 0:
-                        continue
+                f_curr = np.zeros(band_size + 1, dtype=np.int32)
+                j_start, j_end = max(i - max_dist, 0), min(i + max_dist, M)
+                if j_start < j_end:
+                    k_start, k_end = j_start - i + max_dist, j_end - i + max_dist
+                    f_up = f_prev[k_start+1:k_end+1]                                                                     # f[i - 1, j]
+                    f_diag = f_prev[k_start:k_end] + 1                                                               # f[i - 1, j - 1] + 1
+                    is_match = (tokenized_char_codes[j_start:j_end] == raw_char_codes[i])
                     
-                    if i > 0:
-                        g[(i, j)] = 0
-                        f[i, j] = f[i - 1, j]
+                    f_row = np.maximum.accumulate(np.maximum(f_up, np.where(is_match, f_diag, 0)))
+                    f_left = np.zeros_like(f_row)                                                                            # f[i, j - 1]
+                    f_left[1:] = f_row[:-1]
                     
-                    if j > 0 and f[i, j - 1] > f[i, j]:
-                        g[(i, j)] = 1
-                        f[i, j] = f[i, j - 1]
+                    g_row = np.where(f_left > f_up, 1, 0 if i > 0 else -1)
+                    g_row = np.where(is_match & (f_diag > np.maximum(f_up, f_left)), 2, g_row)
                     
-                    f_prev = f[i - 1, j - 1] if i > 0 and j > 0 else 0
-                    
-                    raw_char = prepro_utils.preprocess_text(para_text[i], lower=self.tokenizer.lower_case, remove_space=False)
-                    tokenized_char = tokenized_para_text[j]
-                    if (raw_char == tokenized_char and f_prev + 1 > f[i, j]):
-                        g[(i, j)] = 2
-                        f[i, j] = f_prev + 1
+                    g[i, k_start:k_end] = g_row
+                    f_curr[k_start:k_end] = f_row
+                
+                f_prev = f_curr
             
-            return f, g
+            lcs_score = f_prev[M - N + max_dist] if N > 0 and M > 0 else 0
+            return lcs_score, g
+        
+        # raw chars that normalize to anything but a single char never match
+        raw_char_code_map = {raw_char: ord(norm_char) if len(norm_char) == 1 else -1 for raw_char, norm_char in raw_char_map.items()}
+        raw_char_codes = np.array([raw_char_code_map[raw_char] for raw_char in para_text], dtype=np.int64)
+        tokenized_char_codes = np.array([ord(tokenized_char) for tokenized_char in tokenized_para_text], dtype=np.int64)
         
         max_dist = abs(N - M) + 5
-        for _ in range(2):
-            lcs_matrix, match_mapping = _lcs_match(para_text, tokenized_para_text, N, M, max_N, max_M, max_dist)
+        for match_dist in [max_dist, max_dist * 2]:
+            lcs_score, match_mapping = _lcs_match(raw_char_codes, tokenized_char_codes, N, M, match_dist)
             
-            if lcs_matrix[N - 1, M - 1] > 0.8 * N:
+            if lcs_score > 0.8 * N:
+                break
+        
+        mismatch = lcs_score < 0.8 * N
+        return match_mapping, match_dist, mismatch
+    
+    def _generate_char_mapping(self,
+                               para_text,
+                               tokenized_para_text):
+        """Generate char mapping for raw and tokenized paragraph, as int arrays with -1 for unmatched chars"""
+        N, M = len(para_text), len(tokenized_para_text)
+        raw_char_map = self._generate_raw_char_map(para_text)
+        
+        if self.fast_align:
+            char_mapping = self._generate_fast_mapping(para_text, tokenized_para_text, raw_char_map, N, M)
+            if char_mapping is not None:
+                return char_mapping
+        
+        match_mapping, match_dist, mismatch = self._generate_match_mapping(para_text, tokenized_para_text, raw_char_map, N, M)
+        
+        raw2tokenized_char_index = [-1] * N
+        tokenized2raw_char_index = [-1] * M
+        i, j = N-1, M-1
+        while i >= 0 and j >= 0:
+            k = j - i + match_dist
+            if k < 0 or k >= 2 * match_dist or match_mapping[i, k] < 0:
                 break
             
-            max_dist *= 2
+            if match_mapping[i, k] == 2:
+                raw2tokenized_char_index[i] = j
+                tokenized2raw_char_index[j] = i
+                i, j = i - 1, j - 1
+            elif match_mapping[i, k] == 1:
+                j = j - 1
+            else:
+                i = i - 1
         
-        mismatch = lcs_matrix[N - 1, M - 1] < 0.8 * N
-        return match_mapping, mismatch
+        return np.array(raw2tokenized_char_index, dtype=np.int64), np.array(tokenized2raw_char_index, dtype=np.int64), mismatch
     
     def _convert_tokenized_index(self,
                                  index,
                                  pos,
                                  M=None,
                                  is_start=True):
-        """Convert index for tokenized text"""
-        if index[pos] is not None:
-            return index[pos]
+        """Convert index for tokenized text
         
-        N = len(index)
-        rear = pos
-        while rear < N - 1 and index[rear] is None:
-            rear += 1
-        
-        front = pos
-        while front > 0 and index[front] is None:
-            front -= 1
-        
-        assert index[front] is not None or index[rear] is not None
+        `index` is an int array with -1 for unmatched chars and `pos` is either a position or an array of positions.
+        Unmatched positions are resolved from their nearest matched neighbours, which are found by `searchsorted`
+        over matched positions instead of scanning through unmatched runs.
+        """
+        pos = np.asarray(pos)
+        matched_pos = np.flatnonzero(index >= 0)
+        front_idx = np.searchsorted(matched_pos, pos, side="right") - 1
+        rear_idx = np.searchsorted(matched_pos, pos, side="left")
+        has_front = front_idx >= 0
+        has_rear = rear_idx < len(matched_pos)
         
-        if index[front] is None:
-            if index[rear] >= 1:
-                if is_start:
-                    return 0
-                else:
-                    return index[rear] - 1
-            
-            return index[rear]
+        assert np.all(has_front | has_rear)
         
-        if index[rear] is None:
-            if M is not None and index[front] < M - 1:
-                if is_start:
-                    return index[front] + 1
-                else:
-                    return M - 1
-            
-            return index[front]
+        front = index[matched_pos[np.where(has_front, front_idx, 0)]]
+        rear = index[matched_pos[np.where(has_rear, rear_idx, 0)]]
         
         if is_start:
-            if index[rear] > index[front] + 1:
-                return index[front] + 1
-            else:
-                return index[rear]
+            front_only = np.where(front < M - 1, front + 1, front) if M is not None else front
+            rear_only = np.where(rear >= 1, 0, rear)
+            front_rear = np.where(rear > front + 1, front + 1, rear)
         else:
-            if index[rear] > index[front] + 1:
-                return index[rear] - 1
-            else:
-                return index[front]
+            front_only = np.where(front < M - 1, M - 1, front) if M is not None else front
+            rear_only = np.where(rear >= 1, rear - 1, rear)
+            front_rear = np.where(rear > front + 1, rear - 1, front)
+        
+        return np.where(has_front, np.where(has_rear, front_rear, front_only), rear_only)
     
-    def _find_max_context(self,
-                          doc_spans,
-                          token_idx):
-        """Check if this is the 'max context' doc span for the token.
+    def _generate_max_context(self,
+                              doc_spans,
+                              total_para_length):
+        """Generate the 'max context' doc span for every paragraph token.
 
         Because of the sliding window approach taken to scoring documents, a single
         token can appear in multiple documents. E.g.
@@ -440,85 +704,99 @@ class XLNetExampleProcessor(object):
         it has 1 left context and 3 right context, while span B has 4 left context
         and 0 right context.
         """
-        best_doc_score = None
-        best_doc_idx = None
+        best_doc_score = np.full(total_para_length, -np.inf)
+        best_doc_index = np.full(total_para_length, -1, dtype=np.int64)
         for (doc_idx, doc_span) in enumerate(doc_spans):
             doc_start = doc_span["start"]
             doc_length = doc_span["length"]
             doc_end = doc_start + doc_length - 1
-            if token_idx < doc_start or token_idx > doc_end:
-                continue
             
-            left_context_length = token_idx - doc_start
-            right_context_length = doc_end - token_idx
-            doc_score = min(left_context_length, right_context_length) + 0.01 * doc_length
-            if best_doc_score is None or doc_score > best_doc_score:
-                best_doc_score = doc_score
-                best_doc_idx = doc_idx
+            left_context_length = np.arange(doc_length)
+            right_context_length = doc_length - 1 - left_context_length
+            doc_score = np.minimum(left_context_length, right_context_length) + 0.01 * doc_length
+            
+            is_better = doc_score > best_doc_score[doc_start:doc_end+1]
+            best_doc_score[doc_start:doc_end+1][is_better] = doc_score[is_better]
+            best_doc_index[doc_start:doc_end+1][is_better] = doc_idx
         
-        return best_doc_idx
+        return best_doc_index
+    
+    def _convert_paragraph(self,
+                           para_text):
+        """Converts a raw paragraph into tokens with raw/tokenized char index mapping as int arrays."""
+        para_tokens = self.tokenizer.tokenize(para_text)
+        para_ids = np.array(self.tokenizer.tokens_to_ids(para_tokens), dtype=np.int32)
+        
+        token_lengths = np.array([len(token) for token in para_tokens], dtype=np.int64)
+        char2token_index = np.repeat(np.arange(len(para_tokens)), token_lengths)
+        token2char_end_index = np.cumsum(token_lengths) - 1
+        token2char_start_index = token2char_end_index - token_lengths + 1
+        
+        tokenized_para_text = ''.join(para_tokens).replace(prepro_utils.SPIECE_UNDERLINE, ' ')
+        
+        N = len(para_text)
+        raw2tokenized_char_index, tokenized2raw_char_index, mismatch = self._generate_char_mapping(para_text, tokenized_para_text)
+        
+        token2char_raw_start_index = self._convert_tokenized_index(tokenized2raw_char_index, token2char_start_index, N, is_start=True)
+        token2char_raw_end_index = self._convert_tokenized_index(tokenized2raw_char_index, token2char_end_index, N, is_start=False)
+        
+        return {
+            "para_tokens": para_tokens,
+            "para_ids": para_ids,
+            "char2token_index": char2token_index,
+            "raw2tokenized_char_index": raw2tokenized_char_index,
+            "token2char_raw_start_index": token2char_raw_start_index,
+            "token2char_raw_end_index": token2char_raw_end_index,
+            "mismatch": bool(np.all(raw2tokenized_char_index < 0)) or mismatch
+        }
+    
+    def _get_paragraph(self,
+                       para_text):
+        """Get converted paragraph from LRU cache or paragraph store, so paragraph shared by questions or turns is converted once."""
+        if para_text in self.paragraph_cache:
+            self.paragraph_cache.move_to_end(para_text)
+            return self.paragraph_cache[para_text]
+        
+        paragraph = None
+        if self.paragraph_store is not None:
+            paragraph = self.paragraph_store.get(para_text)
+        
+        if paragraph is None:
+            paragraph = self._convert_paragraph(para_text)
+            if self.paragraph_store is not None:
+                self.paragraph_store.put(para_text, paragraph)
+        
+        if self.paragraph_cache_size > 0:
+            self.paragraph_cache[para_text] = paragraph
+            if len(self.paragraph_cache) > self.paragraph_cache_size:
+                self.paragraph_cache.popitem(last=False)
+        
+        return paragraph
     
     def convert_squad_example(self,
                               example,
                               is_training=True,
-                              logging=False):
-        """Converts a single `InputExample` into a single `InputFeatures`."""
-        query_tokens = self.tokenizer.tokenize(example.question_text)
+                              logging=False,
+                              query_tokens=None):
+        """Converts a single `InputExample` into a single `InputFeatures`, query tokens may be tokenized in batch ahead."""
+        if query_tokens is None:
+            query_tokens = self.tokenizer.tokenize(example.question_text)
+        
         if len(query_tokens) > self.max_query_length:
             query_tokens = query_tokens[:self.max_query_length]
         
-        para_text = example.paragraph_text
-        para_tokens = self.tokenizer.tokenize(example.paragraph_text)
-        
-        char2token_index = []
-        token2char_start_index = []
-        token2char_end_index = []
-        char_idx = 0
-        for i, token in enumerate(para_tokens):
-            char_len = len(token)
-            char2token_index.extend([i] * char_len)
-            token2char_start_index.append(char_idx)
-            char_idx += char_len
-            token2char_end_index.append(char_idx - 1)
-        
-        tokenized_para_text = ''.join(para_tokens).replace(prepro_utils.SPIECE_UNDERLINE, ' ')
-        
-        N, M = len(para_text), len(tokenized_para_text)
-        max_N, max_M = 1024, 1024
-        if N > max_N or M > max_M:
-            max_N = max(N, max_N)
-            max_M = max(M, max_M)
-        
-        match_mapping, mismatch = self._generate_match_mapping(para_text, tokenized_para_text, N, M, max_N, max_M)
+        query_ids = self.tokenizer.tokens_to_ids(query_tokens)
         
-        raw2tokenized_char_index = [None] * N
-        tokenized2raw_char_index = [None] * M
-        i, j = N-1, M-1
-        while i >= 0 and j >= 0:
-            if (i, j) not in match_mapping:
-                break
-            
-            if match_mapping[(i, j)] == 2:
-                raw2tokenized_char_index[i] = j
-                tokenized2raw_char_index[j] = i
-                i, j = i - 1, j - 1
-            elif match_mapping[(i, j)] == 1:
-                j = j - 1
-            else:
-                i = i - 1
+        paragraph = self._get_paragraph(example.paragraph_text)
+        para_tokens = paragraph["para_tokens"]
+        para_ids = paragraph["para_ids"]
+        char2token_index = paragraph["char2token_index"]
+        raw2tokenized_char_index = paragraph["raw2tokenized_char_index"]
+        token2char_raw_start_index = paragraph["token2char_raw_start_index"]
+        token2char_raw_end_index = paragraph["token2char_raw_end_index"]
         
-        if all(v is None for v in raw2tokenized_char_index) or mismatch:
+        if paragraph["mismatch"]:
             tf.logging.warning("raw and tokenized paragraph mismatch detected for example: %s" % example.qas_id)
-        
-        token2char_raw_start_index = []
-        token2char_raw_end_index = []
-        for idx in range(len(para_tokens)):
-            start_pos = token2char_start_index[idx]
-            end_pos = token2char_end_index[idx]
-            raw_start_pos = self._convert_tokenized_index(tokenized2raw_char_index, start_pos, N, is_start=True)
-            raw_end_pos = self._convert_tokenized_index(tokenized2raw_char_index, end_pos, N, is_start=False)
-            token2char_raw_start_index.append(raw_start_pos)
-            token2char_raw_end_index.append(raw_end_pos)
 
         if is_training:
             if not example.is_impossible:
@@ -526,8 +804,8 @@ class XLNetExampleProcessor(object):
                 raw_end_char_pos = raw_start_char_pos + len(example.orig_answer_text) - 1
                 tokenized_start_char_pos = self._convert_tokenized_index(raw2tokenized_char_index, raw_start_char_pos, is_start=True)
                 tokenized_end_char_pos = self._convert_tokenized_index(raw2tokenized_char_index, raw_end_char_pos, is_start=False)
-                tokenized_start_token_pos = char2token_index[tokenized_start_char_pos]
-                tokenized_end_token_pos = char2token_index[tokenized_end_char_pos]
+                tokenized_start_token_pos = int(char2token_index[tokenized_start_char_pos])
+                tokenized_end_token_pos = int(char2token_index[tokenized_end_char_pos])
                 assert tokenized_start_token_pos <= tokenized_end_token_pos
             else:
                 tokenized_start_token_pos = tokenized_end_token_pos = -1
@@ -558,66 +836,51 @@ class XLNetExampleProcessor(object):
             
             para_start += min(para_length, self.doc_stride)
         
+        max_context_doc_index = self._generate_max_context(doc_spans, total_para_length)
+        
+        # Windows are written into preallocated arrays, which are padded up to the sequence length.
+        all_input_ids = np.full((len(doc_spans), self.max_seq_length), self.special_vocab_map["<pad>"], dtype=np.int32)
+        all_input_mask = np.ones((len(doc_spans), self.max_seq_length), dtype=np.int8)
+        all_p_mask = np.ones((len(doc_spans), self.max_seq_length), dtype=np.int8)
+        all_segment_ids = np.full((len(doc_spans), self.max_seq_length), self.segment_vocab_map["<pad>"], dtype=np.int8)
+        
         feature_list = []
         for (doc_idx, doc_span) in enumerate(doc_spans):
-            input_tokens = []
-            segment_ids = []
-            p_mask = []
-            doc_token2char_raw_start_index = []
-            doc_token2char_raw_end_index = []
-            doc_token2doc_index = {}
-            
-            for i in range(doc_span["length"]):
-                token_idx = doc_span["start"] + i
-                
-                doc_token2char_raw_start_index.append(token2char_raw_start_index[token_idx])
-                doc_token2char_raw_end_index.append(token2char_raw_end_index[token_idx])
-                
-                best_doc_idx = self._find_max_context(doc_spans, token_idx)
-                doc_token2doc_index[len(input_tokens)] = (best_doc_idx == doc_idx)
-                
-                input_tokens.append(para_tokens[token_idx])
-                segment_ids.append(self.segment_vocab_map["<p>"])
-                p_mask.append(0)
-            
-            doc_para_length = len(input_tokens)
+            para_start = doc_span["start"]
+            para_end = para_start + doc_span["length"]
             
-            input_tokens.append("<sep>")
-            segment_ids.append(self.segment_vocab_map["<p>"])
-            p_mask.append(1)
+            doc_para_length = doc_span["length"]
+            query_start = doc_para_length + 1
+            query_end = query_start + len(query_ids)
+            cls_index = query_end + 1
             
-            # We put P before Q because during pretraining, B is always shorter than A
-            for query_token in query_tokens:
-                input_tokens.append(query_token)
-                segment_ids.append(self.segment_vocab_map["<q>"])
-                p_mask.append(1)
-
-            input_tokens.append("<sep>")
-            segment_ids.append(self.segment_vocab_map["<q>"])
-            p_mask.append(1)
-            
-            cls_index = len(input_tokens)
+            assert cls_index < self.max_seq_length
             
-            input_tokens.append("<cls>")
-            segment_ids.append(self.segment_vocab_map["<cls>"])
-            p_mask.append(0)
+            doc_token2char_raw_start_index = token2char_raw_start_index[para_start:para_end].astype(np.int32)
+            doc_token2char_raw_end_index = token2char_raw_end_index[para_start:para_end].astype(np.int32)
+            doc_token2doc_index = (max_context_doc_index[para_start:para_end] == doc_idx)
             
-            input_ids = self.tokenizer.tokens_to_ids(input_tokens)
+            # We put P before Q because during pretraining, B is always shorter than A
+            input_ids = all_input_ids[doc_idx]
+            input_ids[:doc_para_length] = para_ids[para_start:para_end]
+            input_ids[doc_para_length] = self.special_vocab_map["<sep>"]
+            input_ids[query_start:query_end] = query_ids
+            input_ids[query_end] = self.special_vocab_map["<sep>"]
+            input_ids[cls_index] = self.special_vocab_map["<cls>"]
             
             # The mask has 0 for real tokens and 1 for padding tokens. Only real tokens are attended to.
-            input_mask = [0] * len(input_ids)
+            input_mask = all_input_mask[doc_idx]
+            input_mask[:cls_index+1] = 0
             
-            # Zero-pad up to the sequence length.
-            while len(input_ids) < self.max_seq_length:
-                input_ids.append(self.special_vocab_map["<pad>"])
-                input_mask.append(1)
-                segment_ids.append(self.segment_vocab_map["<pad>"])
-                p_mask.append(1)
+            segment_ids = all_segment_ids[doc_idx]
+            segment_ids[:query_start] = self.segment_vocab_map["<p>"]
+            segment_ids[query_start:cls_index] = self.segment_vocab_map["<q>"]
+            segment_ids[cls_index] = self.segment_vocab_map["<cls>"]
             
-            assert len(input_ids) == self.max_seq_length
-            assert len(input_mask) == self.max_seq_length
-            assert len(segment_ids) == self.max_seq_length
-            assert len(p_mask) == self.max_seq_length
+            p_mask = all_p_mask[doc_idx]
+            p_mask[:doc_para_length] = 0
+            p_mask[doc_para_length:cls_index] = 1
+            p_mask[cls_index] = 0
             
             start_position = None
             end_position = None
@@ -639,13 +902,14 @@ class XLNetExampleProcessor(object):
                     end_position = cls_index
             
             if logging:
+                input_tokens = para_tokens[para_start:para_end] + ["<sep>"] + query_tokens + ["<sep>", "<cls>"]
                 tf.logging.info("*** Example ***")
                 tf.logging.info("unique_id: %s" % str(self.unique_id))
                 tf.logging.info("qas_id: %s" % example.qas_id)
                 tf.logging.info("doc_idx: %s" % str(doc_idx))
                 tf.logging.info("doc_token2char_raw_start_index: %s" % " ".join([str(x) for x in doc_token2char_raw_start_index]))
                 tf.logging.info("doc_token2char_raw_end_index: %s" % " ".join([str(x) for x in doc_token2char_raw_end_index]))
-                tf.logging.info("doc_token2doc_index: %s" % " ".join(["%d:%s" % (x, y) for (x, y) in doc_token2doc_index.items()]))
+                tf.logging.info("doc_token2doc_index: %s" % " ".join(["%d:%s" % (x, y) for (x, y) in enumerate(doc_token2doc_index)]))
                 tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
                 tf.logging.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
                 tf.logging.info("p_mask: %s" % " ".join([str(x) for x in p_mask]))
@@ -682,16 +946,83 @@ class XLNetExampleProcessor(object):
         
         return feature_list
     
+    def _get_example_shards(self,
+                            examples,
+                            num_shards):
+        """Split examples into contiguous shards at paragraph boundaries, so each paragraph is converted by one worker."""
+        shard_size = max(len(examples) // num_shards, 1)
+        shards = []
+        shard_start = 0
+        for idx in range(1, len(examples) + 1):
+            if idx < len(examples) and examples[idx].paragraph_text == examples[idx-1].paragraph_text:
+                continue
+            
+            if idx - shard_start >= shard_size or idx == len(examples):
+                shards.append((shard_start, idx))
+                shard_start = idx
+        
+        return shards
+    
+    @staticmethod
+    def _init_example_shard_worker(*shard_context):
+        """Set conversion context of worker process, which is given as pool initializer arguments."""
+        XLNetExampleProcessor.shard_context = shard_context
+    
+    @staticmethod
+    def _convert_example_shard(shard):
+        """Convert a shard of examples in worker process, processor and examples are inherited from parent process via fork."""
+        processor, examples, is_training, example_offset = XLNetExampleProcessor.shard_context
+        shard_start, shard_end = shard
+        query_tokens_list = processor.tokenizer.tokenize_batch([example.question_text for example in examples[shard_start:shard_end]])
+        features = []
+        for idx in range(shard_start, shard_end):
+            feature_list = processor.convert_squad_example(examples[idx], is_training, logging=(example_offset + idx < 20),
+                query_tokens=query_tokens_list[idx - shard_start])
+            features.extend(feature_list)
+        
+        return features
+    
+    def _convert_examples_parallel(self,
+                                   examples,
+                                   is_training,
+                                   example_offset):
+        """Convert examples with a pool of worker processes, unique ids are re-assigned in example order to match serial conversion."""
+        shards = self._get_example_shards(examples, self.num_workers * 4)
+        
+        # Initializer arguments are inherited by forked workers as is, so processor and examples are not pickled
+        pool = multiprocessing.get_context("fork").Pool(processes=self.num_workers,
+            initializer=XLNetExampleProcessor._init_example_shard_worker, initargs=(self, examples, is_training, example_offset))
+        try:
+            features = []
+            for (shard_idx, feature_list) in enumerate(pool.imap(XLNetExampleProcessor._convert_example_shard, shards)):
+                tf.logging.info("Writing example %d of %d" % (shards[shard_idx][1], len(examples)))
+                features.extend(feature_list)
+        finally:
+            pool.terminate()
+        
+        for feature in features:
+            feature.unique_id = self.unique_id
+            self.unique_id += 1
+        
+        return features
+    
     def convert_examples_to_features(self,
                                      examples,
-                                     is_training=True):
+                                     is_training=True,
+                                     example_offset=0):
         """Convert a set of `InputExample`s to a list of `InputFeatures`."""
+        # Workers are forked, so conversion falls back to serial on platforms without fork
+        if self.num_workers > 1 and len(examples) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            return self._convert_examples_parallel(examples, is_training, example_offset)
+        
+        query_tokens_list = self.tokenizer.tokenize_batch([example.question_text for example in examples])
         features = []
         for (idx, example) in enumerate(examples):
             if idx % 1000 == 0:
                 tf.logging.info("Writing example %d of %d" % (idx, len(examples)))
 
-            feature_list = self.convert_squad_example(example, is_training, logging=(idx < 20))
+            feature_list = self.convert_squad_example(example, is_training, logging=(example_offset + idx < 20),
+                query_tokens=query_tokens_list[idx])
             features.extend(feature_list)
 
         return features
@@ -699,31 +1030,324 @@ class XLNetExampleProcessor(object):
     def save_features_as_tfrecord(self,
                                   features,
                                   output_file,
-                                  is_training=True):
-        """Save a set of `InputFeature`s to a TFRecord file."""
-        def create_int_feature(values):
-            return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-        
-        def create_float_feature(values):
-            return tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
-        
-        with tf.python_io.TFRecordWriter(output_file) as writer:
-            for feature in features:
-                features = collections.OrderedDict()
-                features["unique_id"] = create_int_feature([feature.unique_id])
-                features["input_ids"] = create_int_feature(feature.input_ids)
-                features["input_mask"] = create_float_feature(feature.input_mask)
-                features["p_mask"] = create_float_feature(feature.p_mask)
-                features["segment_ids"] = create_int_feature(feature.segment_ids)
-                features["cls_index"] = create_int_feature([feature.cls_index])
-                
-                if is_training == True:
-                    features["start_position"] = create_int_feature([feature.start_position])
-                    features["end_position"] = create_int_feature([feature.end_position])
-                    features["is_impossible"] = create_float_feature([1 if feature.is_impossible else 0])
+                                  is_training=True,
+                                  features_per_record=1,
+                                  pack_size=1):
+        """Save a set of `InputFeature`s to a TFRecord file, examples are encoded without TensorFlow.
+        
+        With `features_per_record` larger than 1, each record holds values of that many features concatenated, and the last
+        record is filled up with features from the start of the file, so that all records are of the same shape. Fill features
+        are weighted 0 in loss by `feature_weight` (or `pack_weight` of packed rows), so that they are not trained on twice.
+        With `pack_size` larger than 1, features are packed into rows of up to that many features (see `_pack_features`),
+        and each row is saved in place of a feature.
+        """
+        if pack_size > 1:
+            record_features = [self._encode_packed_row(row, pack_size, is_training) for row in self._pack_features(features, pack_size)]
+        else:
+            record_features = [self._encode_feature(feature, is_training, self.compact_tfrecord) for feature in features]
+        
+        num_fill_features = -len(record_features) % features_per_record
+        fill_features = [record_features[idx % len(record_features)] for idx in range(num_fill_features)]
+        if features_per_record > 1:
+            if pack_size > 1:
+                fill_weight = {"pack_weight": encode_float_feature([0.0] * pack_size)}
+            else:
+                for record_feature in record_features:
+                    record_feature["feature_weight"] = encode_float_feature([1.0])
                 
-                tf_example = tf.train.Example(features=tf.train.Features(feature=features))
-                writer.write(tf_example.SerializeToString())
+                fill_weight = {"feature_weight": encode_float_feature([0.0])}
+            
+            fill_features = [collections.OrderedDict(fill_feature, **fill_weight) for fill_feature in fill_features]
+        
+        record_features.extend(fill_features)
+        with TFRecordWriter(output_file, compression_type=self.record_compression) as writer:
+            for record_start in range(0, len(record_features), features_per_record):
+                writer.write(encode_batched_example(record_features[record_start:record_start+features_per_record]))
+    
+    def _encode_feature(self,
+                        feature,
+                        is_training=True,
+                        compact_tfrecord=False,
+                        packed=False):
+        """Encode an `InputFeature` as a dict of serialized features, sequence features are left out if the feature is packed into a row."""
+        features = collections.OrderedDict()
+        features["unique_id"] = encode_int_feature([feature.unique_id])
+        if packed:
+            # Sequence features are laid out in packed row, only <cls> position is saved per slot
+            features["cls_index"] = encode_int_feature([feature.cls_index])
+        elif compact_tfrecord:
+            # Only real tokens are saved as packed int32 bytes, padding and masks are rebuilt from lengths in input function
+            input_length = feature.cls_index + 1
+            features["input_ids"] = encode_bytes_feature([np.asarray(feature.input_ids[:input_length], dtype="<i4").tobytes()])
+            features["para_length"] = encode_int_feature([feature.para_length])
+            features["query_length"] = encode_int_feature([feature.cls_index - feature.para_length - 2])
+        else:
+            features["input_ids"] = encode_int_feature(feature.input_ids)
+            features["input_mask"] = encode_float_feature(feature.input_mask)
+            features["p_mask"] = encode_float_feature(feature.p_mask)
+            features["segment_ids"] = encode_int_feature(feature.segment_ids)
+            features["cls_index"] = encode_int_feature([feature.cls_index])
+        
+        if is_training == True:
+            features["start_position"] = encode_int_feature([feature.start_position])
+            features["end_position"] = encode_int_feature([feature.end_position])
+            features["is_impossible"] = encode_float_feature([1 if feature.is_impossible else 0])
+        
+        return features
+    
+    def _shift_feature(self,
+                       feature,
+                       offset):
+        """Shift positions of an `InputFeature` by offset, as the feature is packed at offset of a row."""
+        feature = copy.copy(feature)
+        feature.cls_index += offset
+        feature.start_position += offset
+        feature.end_position += offset
+        return feature
+    
+    def _pack_features(self,
+                       features,
+                       pack_size):
+        """Pack `InputFeature`s into rows of `max_seq_length` by true length (up to <cls>), each row holds at most `pack_size` features.
+        
+        Features are placed from the longest with best fit, i.e. into the open row with the least room left that still fits,
+        open rows are kept sorted by room left. Rows are shuffled, as features are placed in order of length.
+        """
+        rows = []
+        open_rows = []
+        for feature in sorted(features, key=lambda feature: feature.cls_index, reverse=True):
+            input_length = feature.cls_index + 1
+            open_idx = bisect.bisect_left(open_rows, (input_length, -1))
+            if open_idx < len(open_rows):
+                row_room, row_idx = open_rows.pop(open_idx)
+            else:
+                row_room, row_idx = self.max_seq_length, len(rows)
+                rows.append([])
+            
+            rows[row_idx].append(feature)
+            if len(rows[row_idx]) < pack_size and row_room > input_length:
+                bisect.insort(open_rows, (row_room - input_length, row_idx))
+        
+        np.random.shuffle(rows)
+        return rows
+    
+    def _encode_packed_row(self,
+                           row,
+                           pack_size,
+                           is_training=True):
+        """Encode a row of packed `InputFeature`s as a dict of serialized features.
+        
+        Input ids, masks and segment ids of features are laid out one after another, and `pack_ids` gives the slot of each token
+        (`pack_size` for padding). Other features are saved per slot with positions shifted into the row, empty slots repeat the
+        first slot and are weighted 0 by `pack_weight`.
+        """
+        input_ids = np.full(self.max_seq_length, self.special_vocab_map["<pad>"], dtype=np.int32)
+        input_mask = np.ones(self.max_seq_length, dtype=np.int8)
+        p_mask = np.ones(self.max_seq_length, dtype=np.int8)
+        segment_ids = np.full(self.max_seq_length, self.segment_vocab_map["<pad>"], dtype=np.int8)
+        pack_ids = np.full(self.max_seq_length, pack_size, dtype=np.int32)
+        
+        slot_features = []
+        offset = 0
+        for (slot_idx, feature) in enumerate(row):
+            input_length = feature.cls_index + 1
+            input_ids[offset:offset+input_length] = feature.input_ids[:input_length]
+            input_mask[offset:offset+input_length] = feature.input_mask[:input_length]
+            p_mask[offset:offset+input_length] = feature.p_mask[:input_length]
+            segment_ids[offset:offset+input_length] = feature.segment_ids[:input_length]
+            pack_ids[offset:offset+input_length] = slot_idx
+            slot_features.append(self._encode_feature(self._shift_feature(feature, offset), is_training, packed=True))
+            offset += input_length
+        
+        slot_features.extend([slot_features[0]] * (pack_size - len(row)))
+        
+        features = collections.OrderedDict()
+        features["input_ids"] = encode_int_feature(input_ids)
+        features["input_mask"] = encode_float_feature(input_mask)
+        features["p_mask"] = encode_float_feature(p_mask)
+        features["segment_ids"] = encode_int_feature(segment_ids)
+        for name in slot_features[0].keys():
+            features[name] = concat_features([slot_feature[name] for slot_feature in slot_features])
+        
+        features["pack_ids"] = encode_int_feature(pack_ids)
+        features["pack_weight"] = encode_float_feature([1.0] * len(row) + [0.0] * (pack_size - len(row)))
+        
+        return features
+    
+    def save_features_as_tfrecord_shards(self,
+                                         features,
+                                         output_file,
+                                         num_shards,
+                                         is_training=True):
+        """Save a set of `InputFeature`s to TFRecord shards `<output_file>-<shard_idx>`, shards are recorded in `<output_file>.manifest.json`.
+        
+        Features are split into contiguous shards which are encoded and compressed by a thread each, zlib releases GIL while compressing.
+        """
+        shard_files = ["{0}-{1:05d}".format(output_file, shard_idx) for shard_idx in range(num_shards)]
+        shard_bounds = np.linspace(0, len(features), num_shards + 1).astype(np.int64).tolist()
+        
+        def _save_shard(shard_idx):
+            temp_file = "{0}.tmp".format(shard_files[shard_idx])
+            self.save_features_as_tfrecord(features[shard_bounds[shard_idx]:shard_bounds[shard_idx+1]], temp_file, is_training)
+            os.replace(temp_file, shard_files[shard_idx])
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(num_shards, self.num_workers), 1)) as executor:
+            list(executor.map(_save_shard, range(num_shards)))
+        
+        manifest = {
+            "compression_type": self.record_compression,
+            "shards": [{
+                "shard_idx": shard_idx,
+                "num_features": shard_bounds[shard_idx+1] - shard_bounds[shard_idx]
+            } for shard_idx in range(num_shards)]
+        }
+        self._save_manifest(manifest, "{0}.manifest.json".format(output_file))
+        
+        return shard_files
+    
+    def save_units_as_tfrecord_shards(self,
+                                      unit_fn,
+                                      output_file,
+                                      shard_size,
+                                      overwrite=False,
+                                      is_training=True):
+        """Convert units of `InputExample`s (e.g. articles or stories) and save features to TFRecord shards `<output_file>-<shard_idx>`.
+        
+        `unit_fn` returns an iterator of (unit_id, unit_hash, unit_examples) tuples, where unit_examples are generated lazily.
+        Content hash and unique id range of each unit, and units of each shard are recorded in `<output_file>.manifest.json`.
+        Shards with all units unchanged are kept as is, only new or changed units (and units sharing a shard with them) are
+        converted into new shards, which are shuffled and written one at a time. Unchanged units keep their unique id ranges
+        and new or changed units get fresh ranges, so unique ids already saved with features stay valid.
+        """
+        manifest_file = "{0}.manifest.json".format(output_file)
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r") as file:
+                manifest = json.load(file)
+        else:
+            manifest = {
+                "next_unique_id": self.unique_id,
+                "next_shard_idx": 0,
+                "units": {},
+                "shards": []
+            }
+        
+        if overwrite:
+            manifest["next_unique_id"] = self.unique_id
+            manifest["units"] = {}
+        
+        unit_hashes = {}
+        for unit_id, unit_hash, _ in unit_fn():
+            if unit_id in unit_hashes:
+                raise ValueError("duplicate unit id: {0}".format(unit_id))
+            
+            unit_hashes[unit_id] = unit_hash
+        
+        kept_shards = []
+        dropped_shards = []
+        for shard in manifest["shards"]:
+            if all([unit_id in manifest["units"] and manifest["units"][unit_id][0] == unit_hashes.get(unit_id) for unit_id in shard["unit_ids"]]):
+                kept_shards.append(shard)
+            else:
+                dropped_shards.append(shard)
+        
+        manifest["shards"] = kept_shards
+        manifest["units"] = {unit_id: unit for unit_id, unit in manifest["units"].items() if unit_id in unit_hashes}
+        self._save_manifest(manifest, manifest_file)
+        
+        for shard in dropped_shards:
+            for shard_file in ["{0}-{1:05d}".format(output_file, shard["shard_idx"])]:
+                if os.path.exists(shard_file):
+                    os.remove(shard_file)
+        
+        tf.logging.info("Keep %d shards of %d units, drop %d shards" % (len(kept_shards),
+            sum([len(shard["unit_ids"]) for shard in kept_shards]), len(dropped_shards)))
+        
+        skipped_unit_ids = set([unit_id for shard in kept_shards for unit_id in shard["unit_ids"]])
+        num_converted_examples = 0
+        for shard_units in self._get_unit_shards(unit_fn(), skipped_unit_ids, shard_size):
+            shard_examples = [example for _, _, unit_examples in shard_units for example in unit_examples]
+            shard_features = self.convert_examples_to_features(shard_examples, is_training, num_converted_examples)
+            self._assign_unit_unique_ids(shard_units, shard_features, manifest)
+            if is_training:
+                np.random.shuffle(shard_features)
+            
+            shard_idx = manifest["next_shard_idx"]
+            shard_file = "{0}-{1:05d}".format(output_file, shard_idx)
+            temp_file = "{0}.tmp".format(shard_file)
+            self.save_features_as_tfrecord(shard_features, temp_file, is_training, self.features_per_record,
+                self.pack_size if is_training else 1)
+            os.replace(temp_file, shard_file)
+            
+            manifest["next_shard_idx"] += 1
+            manifest["shards"].append({
+                "shard_idx": shard_idx,
+                "unit_ids": [unit_id for unit_id, _, _ in shard_units],
+                "num_features": len(shard_features)
+            })
+            self._save_manifest(manifest, manifest_file)
+            
+            num_converted_examples += len(shard_examples)
+        
+        self.unique_id = max(self.unique_id, manifest["next_unique_id"])
+        
+        tf.logging.info("Saved %d features from %d units to %d shards, %d examples are converted" % (
+            sum([shard["num_features"] for shard in manifest["shards"]]), len(manifest["units"]), len(manifest["shards"]), num_converted_examples))
+        
+        return ["{0}-{1:05d}".format(output_file, shard["shard_idx"]) for shard in manifest["shards"]]
+    
+    def _get_unit_shards(self,
+                         units,
+                         skipped_unit_ids,
+                         shard_size):
+        """Group units into shards of at least `shard_size` examples, skipped units are not generated."""
+        shard_units = []
+        num_shard_examples = 0
+        for unit_id, unit_hash, unit_examples in units:
+            if unit_id in skipped_unit_ids:
+                continue
+            
+            skipped_unit_ids.add(unit_id)
+            unit_examples = list(unit_examples)
+            shard_units.append((unit_id, unit_hash, unit_examples))
+            num_shard_examples += len(unit_examples)
+            if num_shard_examples >= shard_size:
+                yield shard_units
+                shard_units = []
+                num_shard_examples = 0
+        
+        if shard_units:
+            yield shard_units
+    
+    def _assign_unit_unique_ids(self,
+                                units,
+                                features,
+                                manifest):
+        """Assign unique ids to features in order of units, unchanged units with same number of features keep their id ranges."""
+        feature_idx = 0
+        for unit_id, unit_hash, unit_examples in units:
+            qas_ids = set([example.qas_id for example in unit_examples])
+            unit_start = feature_idx
+            while feature_idx < len(features) and features[feature_idx].qas_id in qas_ids:
+                feature_idx += 1
+            
+            num_features = feature_idx - unit_start
+            unit = manifest["units"].get(unit_id)
+            if unit is None or unit[0] != unit_hash or unit[2] != num_features:
+                unit = [unit_hash, manifest["next_unique_id"], num_features]
+                manifest["units"][unit_id] = unit
+                manifest["next_unique_id"] += num_features
+            
+            for idx in range(num_features):
+                features[unit_start + idx].unique_id = unit[1] + idx
+    
+    def _save_manifest(self,
+                       manifest,
+                       manifest_file):
+        temp_manifest_file = "{0}.tmp".format(manifest_file)
+        with open(temp_manifest_file, "w") as file:
+            json.dump(manifest, file)
+        
+        os.replace(temp_manifest_file, manifest_file)
     
     def save_features_as_pickle(self,
                                 features,
@@ -750,8 +1374,40 @@ class XLNetInputBuilder(object):
                      is_training,
                      drop_remainder,
                      shuffle_buffer=2048,
-                     num_threads=16):
-        """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                     num_threads=16,
+                     compact_vocab=None,
+                     compression_type="",
+                     batch_parse=False,
+                     features_per_record=1,
+                     prefetch_memory=256,
+                     bucket_boundaries=None,
+                     pack_size=1,
+                     time_major=False):
+        """Creates an `input_fn` closure to be passed to TPUEstimator, `input_file` is a TFRecord file, a glob pattern of TFRecord shards or a list of them.
+        
+        Shards are shuffled at file level and read with parallel interleave, sloppy (non-deterministic) order is only allowed for training.
+        If `compact_vocab` (special and segment vocab maps of example processor) is given, records are read in compact schema,
+        i.e. unpadded input ids with paragraph and query lengths, and padding and masks are rebuilt in graph.
+        With `batch_parse`, serialized records are batched first and each batch is parsed and cast by a single op, which is
+        required for records pre-batched with `features_per_record` features. Prefetched batches are bounded by `prefetch_memory` (in MB).
+        If `bucket_boundaries` is given, examples are grouped into buckets by true sequence length (up to <cls>), and each batch
+        is trimmed to its bucket boundary instead of `seq_length`, so that less compute is spent on padding.
+        If `pack_size` is larger than 1, records are rows of packed features, which are always saved in full schema, and
+        per-slot features are read with an extra dim of `pack_size` (see `XLNetExampleProcessor._encode_packed_row`).
+        With `time_major`, input ids, input mask and segment ids of each batch are transposed to [l,b] in input pipeline,
+        which are fed to XLNet as is.
+        """
+        if pack_size > 1:
+            if bucket_boundaries is not None:
+                raise ValueError("packed records can't be bucketed by length")
+            
+            compact_vocab = None
+        
+        batch_parse = batch_parse or features_per_record > 1
+        if bucket_boundaries is not None:
+            bucket_lengths = sorted(set([boundary for boundary in bucket_boundaries if boundary < seq_length] + [seq_length]))
+        input_files = input_file if isinstance(input_file, list) else tf.gfile.Glob(input_file)
+        
         name_to_features = {
             "unique_id": tf.FixedLenFeature([], tf.int64),
             "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
@@ -761,23 +1417,115 @@ class XLNetInputBuilder(object):
             "cls_index": tf.FixedLenFeature([], tf.int64),
         }
         
+        if compact_vocab is not None:
+            for name in ["input_mask", "p_mask", "segment_ids", "cls_index"]:
+                del name_to_features[name]
+            
+            name_to_features["input_ids"] = tf.FixedLenFeature([], tf.string)
+            name_to_features["para_length"] = tf.FixedLenFeature([], tf.int64)
+            name_to_features["query_length"] = tf.FixedLenFeature([], tf.int64)
+        
         if is_training:
             name_to_features["start_position"] = tf.FixedLenFeature([], tf.int64)
             name_to_features["end_position"] = tf.FixedLenFeature([], tf.int64)
             name_to_features["is_impossible"] = tf.FixedLenFeature([], tf.float32)
         
-        def _decode_record(record,
-                           name_to_features):
-            """Decodes a record to a TensorFlow example."""
-            example = tf.parse_single_example(record, name_to_features)
+        if pack_size > 1:
+            name_to_features = {name: tf.FixedLenFeature(feature.shape if name in ["input_ids", "input_mask", "p_mask", "segment_ids"]
+                else [pack_size] + feature.shape, feature.dtype) for name, feature in name_to_features.items()}
+            name_to_features["pack_ids"] = tf.FixedLenFeature([seq_length], tf.int64)
+            name_to_features["pack_weight"] = tf.FixedLenFeature([pack_size], tf.float32)
+        
+        if features_per_record > 1:
+            if pack_size == 1:
+                name_to_features["feature_weight"] = tf.FixedLenFeature([], tf.float32)
+            
+            name_to_features = {name: tf.FixedLenFeature([features_per_record] + feature.shape, feature.dtype)
+                for name, feature in name_to_features.items()}
+        
+        def _expand_compact_record(example):
+            """Rebuilds padded input ids, masks and segment ids of compact records (a record or a batch of them) from paragraph and query lengths."""
+            special_vocab_map, segment_vocab_map = compact_vocab
+            para_length = tf.expand_dims(tf.to_int32(example.pop("para_length")), -1)
+            query_length = tf.expand_dims(tf.to_int32(example.pop("query_length")), -1)
+            query_start = para_length + 1
+            cls_index = query_start + query_length + 1
+            
+            # Packed ids are padded as bytes, so that ids of different lengths are decoded together
+            pad_bytes = np.full(seq_length, special_vocab_map["<pad>"], dtype="<i4").tobytes()
+            pad_length = 4 * (seq_length - cls_index - 1)
+            padding = tf.substr(tf.fill(tf.shape(pad_length), pad_bytes), tf.zeros_like(pad_length), pad_length)
+            input_ids = tf.decode_raw(tf.string_join([tf.expand_dims(example["input_ids"], -1), padding]), tf.int32)
+            input_ids = tf.squeeze(input_ids, axis=-2)
+            input_ids.set_shape(cls_index.shape[:-1].concatenate([seq_length]))
+            
+            # Positions are grouped into paragraph (with the first <sep>), query (with the second <sep>), <cls> and padding
+            seq_index = tf.range(seq_length)
+            seq_region = tf.to_int32(seq_index >= query_start) + tf.to_int32(seq_index >= cls_index) + tf.to_int32(seq_index > cls_index)
+            segment_table = tf.constant([segment_vocab_map[segment_vocab] for segment_vocab in ["<p>", "<q>", "<cls>", "<pad>"]], dtype=tf.int32)
+            
+            example["input_ids"] = input_ids
+            example["input_mask"] = tf.to_float(seq_index > cls_index)
+            example["p_mask"] = tf.to_float(tf.logical_and(seq_index >= para_length, tf.not_equal(seq_index, cls_index)))
+            example["segment_ids"] = tf.gather(segment_table, seq_region)
+            example["cls_index"] = tf.squeeze(cls_index, axis=-1)
             
+            return example
+        
+        def _cast_example(example):
             # tf.Example only supports tf.int64, but the TPU only supports tf.int32. So cast all int64 to int32.
             for name in list(example.keys()):
                 t = example[name]
                 if t.dtype == tf.int64:
                     t = tf.to_int32(t)
                 example[name] = t
-
+            
+            return example
+        
+        def _decode_record(record,
+                           name_to_features):
+            """Decodes a record to a TensorFlow example."""
+            example = tf.parse_single_example(record, name_to_features)
+            
+            if compact_vocab is not None:
+                example = _expand_compact_record(example)
+            
+            return _cast_example(example)
+        
+        def _decode_batch(records,
+                          name_to_features):
+            """Decodes a batch of records to a batch of TensorFlow examples, pre-batched records are flattened."""
+            example = tf.parse_example(records, name_to_features)
+            
+            if features_per_record > 1:
+                for name in list(example.keys()):
+                    example[name] = tf.reshape(example[name], [-1] + example[name].shape[2:].as_list())
+            
+            if compact_vocab is not None:
+                example = _expand_compact_record(example)
+            
+            return _cast_example(example)
+        
+        def _get_bucket_id(example):
+            """Gets bucket id of an example by its true sequence length."""
+            example_length = example["cls_index"] + 1
+            return tf.reduce_sum(tf.to_int64(example_length > tf.constant(bucket_lengths, dtype=tf.int32)))
+        
+        def _trim_batch(example,
+                        bucket_id):
+            """Trims sequence features of a batch to its bucket boundary."""
+            bucket_length = tf.gather(tf.constant(bucket_lengths, dtype=tf.int32), bucket_id)
+            for name in list(example.keys()):
+                if example[name].shape.as_list()[1:] == [seq_length]:
+                    example[name] = example[name][:, :bucket_length]
+            
+            return example
+        
+        def _transpose_batch(example):
+            """Transposes input ids, input mask and segment ids of a batch to time major, i.e. [b,l] --> [l,b]."""
+            for name in ["input_ids", "input_mask", "segment_ids"]:
+                example[name] = tf.transpose(example[name], perm=[1,0])
+            
             return example
         
         def input_fn(params):
@@ -786,25 +1534,63 @@ class XLNetInputBuilder(object):
             
             # For training, we want a lot of parallel reading and shuffling.
             # For eval, we want no shuffling and parallel reading doesn't matter.
-            d = tf.data.TFRecordDataset(input_file)
-            
             if is_training:
+                d = tf.data.Dataset.from_tensor_slices(input_files)
+                d = d.shuffle(buffer_size=len(input_files), seed=np.random.randint(10000))
                 d = d.repeat()
+                d = d.apply(tf.contrib.data.parallel_interleave(
+                    lambda record_file: tf.data.TFRecordDataset(record_file, compression_type=compression_type),
+                    cycle_length=min(len(input_files), num_threads),
+                    sloppy=True))
                 d = d.shuffle(buffer_size=shuffle_buffer, seed=np.random.randint(10000))
+            else:
+                d = tf.data.Dataset.from_tensor_slices(input_files)
+                d = d.apply(tf.contrib.data.parallel_interleave(
+                    lambda record_file: tf.data.TFRecordDataset(record_file, compression_type=compression_type),
+                    cycle_length=min(len(input_files), num_threads),
+                    sloppy=False))
+            
+            if batch_parse and batch_size % features_per_record != 0:
+                raise ValueError("batch size {0} is not a multiple of features per record {1}".format(batch_size, features_per_record))
+            
+            if bucket_boundaries is not None:
+                if batch_parse:
+                    d = d.batch(batch_size // features_per_record)
+                    d = d.map(lambda records: _decode_batch(records, name_to_features), num_parallel_calls=num_threads)
+                    d = d.apply(tf.contrib.data.unbatch())
+                else:
+                    d = d.map(lambda record: _decode_record(record, name_to_features), num_parallel_calls=num_threads)
+                
+                d = d.apply(tf.contrib.data.group_by_window(
+                    key_func=_get_bucket_id,
+                    reduce_func=lambda bucket_id, window: window.batch(batch_size, drop_remainder=drop_remainder).map(
+                        lambda example: _trim_batch(example, bucket_id)),
+                    window_size=batch_size))
+            elif batch_parse:
+                d = d.batch(batch_size // features_per_record, drop_remainder=drop_remainder)
+                d = d.map(lambda records: _decode_batch(records, name_to_features), num_parallel_calls=num_threads)
+            else:
+                d = d.apply(tf.contrib.data.map_and_batch(
+                    lambda record: _decode_record(record, name_to_features),
+                    batch_size=batch_size,
+                    num_parallel_batches=num_threads,
+                    drop_remainder=drop_remainder))
             
-            d = d.apply(tf.contrib.data.map_and_batch(
-                lambda record: _decode_record(record, name_to_features),
-                batch_size=batch_size,
-                num_parallel_batches=num_threads,
-                drop_remainder=drop_remainder))
+            # All decoded tensors are 4-byte int32 or float32, bucketed lengths are counted as full sequence length
+            batch_bytes = batch_size * sum([4 * int(np.prod([dim or seq_length for dim in shape[1:].as_list()])) for shape in d.output_shapes.values()])
+            prefetch_batches = max(prefetch_memory * (1 << 20) // batch_bytes, 1)
             
-            return d.prefetch(1024)
+            if time_major:
+                d = d.map(_transpose_batch, num_parallel_calls=num_threads)
+            
+            return d.prefetch(prefetch_batches)
         
         return input_fn
     
     @staticmethod
-    def get_serving_input_fn(seq_length):
-        """Creates an `input_fn` closure to be passed to TPUEstimator."""
+    def get_serving_input_fn(seq_length,
+                             time_major=False):
+        """Creates an `input_fn` closure to be passed to TPUEstimator, serving inputs are batch major and transposed in graph if `time_major`."""
         def serving_input_fn():
             with tf.variable_scope("serving"):
                 features = {
@@ -816,7 +1602,15 @@ class XLNetInputBuilder(object):
                     'cls_index': tf.placeholder(tf.int32, [None], name='cls_index'),
                 }
                 
-                return tf.estimator.export.build_raw_serving_input_receiver_fn(features)()
+                receiver = tf.estimator.export.build_raw_serving_input_receiver_fn(features)()
+                if time_major:
+                    time_major_features = dict(receiver.features)
+                    for name in ["input_ids", "input_mask", "segment_ids"]:
+                        time_major_features[name] = tf.transpose(time_major_features[name], perm=[1,0])
+                    
+                    receiver = tf.estimator.export.ServingInputReceiver(time_major_features, receiver.receiver_tensors)
+                
+                return receiver
         
         return serving_input_fn
 
@@ -824,10 +1618,12 @@ class XLNetModelBuilder(object):
     """Default model builder for XLNet"""
     def __init__(self,
                  model_config,
-                 use_tpu=False):
+                 use_tpu=False,
+                 time_major=False):
         """Construct XLNet model builder"""
         self.model_config = model_config
         self.use_tpu = use_tpu
+        self.time_major = time_major
     
     def _generate_masked_data(self,
                               input_data,
@@ -841,6 +1637,115 @@ class XLNetModelBuilder(object):
         """Generate one-hot label"""
         return tf.one_hot(input_data, depth=input_depth, on_value=1.0, off_value=0.0, dtype=tf.float32)
     
+    def _generate_time_major(self,
+                             input_data):
+        """Generate time major data, [b,l,...] --> [l,b,...] unless already time major"""
+        if self.time_major:
+            return input_data
+        
+        return tf.transpose(input_data, perm=[1,0] + list(range(2, input_data.shape.ndims)))
+    
+    def _generate_batch_major(self,
+                              input_data):
+        """Generate batch major data, [l,b,...] --> [b,l,...] if time major"""
+        if not self.time_major:
+            return input_data
+        
+        return tf.transpose(input_data, perm=[1,0] + list(range(2, input_data.shape.ndims)))
+    
+    def _generate_sequence_select(self,
+                                  input_index,
+                                  input_data):
+        """Generate data selected at sequence positions, [b,k], [b,l,h] --> [b,k,h] (or [b,k], [l,b,h] --> [b,k,h] if time major)"""
+        if self.time_major:
+            # Rows are gathered from sequence data as is, so that sequence data is not transposed
+            batch_index = tf.tile(tf.expand_dims(tf.range(tf.shape(input_index)[0]), axis=-1), multiples=[1,tf.shape(input_index)[1]])
+            return tf.gather_nd(input_data, tf.stack([input_index, batch_index], axis=-1))
+        
+        return tf.matmul(self._generate_onehot_label(input_index, tf.shape(input_data)[1]), input_data)
+    
+    def _generate_sequence_sum(self,
+                               input_weight,
+                               input_data):
+        """Generate data summed over sequence by weight, [b,l], [b,l,h] --> [b,1,h] (or [b,l], [l,b,h] --> [b,1,h] if time major)"""
+        if self.time_major:
+            # Only the small weight is transposed, [b,l] --> [l,b,1]
+            weighted_data = tf.expand_dims(tf.transpose(input_weight, perm=[1,0]), axis=-1) * input_data
+            return tf.expand_dims(tf.reduce_sum(weighted_data, axis=0), axis=1)
+        
+        return tf.matmul(tf.expand_dims(input_weight, axis=1), input_data)
+    
+    def _generate_sequence_tile(self,
+                                input_data,
+                                seq_len):
+        """Generate data tiled along sequence, [b,1,...] --> [b,l,...] (or [b,1,...] --> [l,b,...] if time major)"""
+        multiples = [1] * input_data.shape.ndims
+        if self.time_major:
+            input_data = tf.transpose(input_data, perm=[1,0] + list(range(2, input_data.shape.ndims)))
+            multiples[0] = seq_len
+        else:
+            multiples[1] = seq_len
+        
+        return tf.tile(input_data, multiples=multiples)
+    
+    def _generate_slot_data(self,
+                            input_data,
+                            pack_size):
+        """Generate data of packed example slots from data of packed rows, [b,...] --> [b*p,...]"""
+        return tf.gather(input_data, tf.range(tf.shape(input_data)[0] * pack_size) // pack_size)
+    
+    def _generate_slot_select(self,
+                              input_index,
+                              input_data,
+                              pack_size):
+        """Generate data selected at sequence positions of packed example slots, [b*p], [b,l,h] --> [b*p,1,h] (or [b*p], [l,b,h] --> [b*p,1,h] if time major)"""
+        slot_data = self._generate_sequence_select(tf.reshape(input_index, [-1,pack_size]), input_data)              # [b,p], [b,l,h] --> [b,p,h]
+        return tf.reshape(slot_data, [-1,1,input_data.shape.as_list()[-1]])
+    
+    def _generate_slot_sum(self,
+                           input_weight,
+                           input_data,
+                           pack_ids,
+                           pack_size):
+        """Generate data summed over sequence by weight of packed example slots, [b*p,l], [b,l,h] --> [b*p,1,h] (or [b*p,l], [l,b,h] --> [b*p,1,h] if time major)"""
+        # Slots of a row don't overlap, so each token is weighted by its own slot and weighted data is summed by slot
+        batch_size, seq_len = tf.shape(pack_ids)[0], tf.shape(pack_ids)[1]
+        hidden_size = input_data.shape.as_list()[-1]
+        slot_mask = tf.transpose(self._generate_onehot_label(pack_ids, pack_size), perm=[0,2,1])                 # [b,l] --> [b,p,l]
+        slot_weight = tf.reshape(input_weight, [batch_size,pack_size,seq_len]) * slot_mask                        # [b*p,l] --> [b,p,l]
+        if not self.time_major:
+            return tf.reshape(tf.matmul(slot_weight, input_data), [-1,1,hidden_size])
+        
+        token_weight = tf.transpose(tf.reduce_sum(slot_weight, axis=1), perm=[1,0])                                  # [b,p,l] --> [l,b]
+        segment_ids = tf.transpose(pack_ids + tf.expand_dims(tf.range(batch_size) * (pack_size + 1), axis=-1), perm=[1,0])  # [b,l] --> [l,b]
+        slot_data = tf.unsorted_segment_sum(tf.reshape(tf.expand_dims(token_weight, axis=-1) * input_data, [-1,hidden_size]),
+            tf.reshape(segment_ids, [-1]), num_segments=batch_size * (pack_size + 1))                                # [l,b,h] --> [b*(p+1),h]
+        slot_data = tf.reshape(slot_data, [batch_size,pack_size+1,hidden_size])[:,:pack_size]                      # [b*(p+1),h] --> [b,p,h]
+        return tf.reshape(slot_data, [-1,1,hidden_size])
+    
+    def _generate_slot_feature(self,
+                               input_data,
+                               pack_ids):
+        """Generate data of packed example slots spread to tokens of each slot, [b*p,1,h], [b,l] --> [b,l,h] (or [b*p,1,h], [b,l] --> [l,b,h] if time major)"""
+        batch_size, seq_len = tf.shape(pack_ids)[0], tf.shape(pack_ids)[1]
+        slot_data = tf.reshape(input_data, [batch_size,-1,input_data.shape.as_list()[-1]])                         # [b*p,1,h] --> [b,p,h]
+        slot_data = tf.pad(slot_data, [[0,0],[0,1],[0,0]])                                                            # padding tokens get zeros, [b,p,h] --> [b,p+1,h]
+        batch_index = tf.tile(tf.expand_dims(tf.range(batch_size), axis=-1), multiples=[1,seq_len])
+        token_index = tf.stack([batch_index, pack_ids], axis=-1)                                                          # [b,l,2]
+        if self.time_major:
+            token_index = tf.transpose(token_index, perm=[1,0,2])                                                   # [b,l,2] --> [l,b,2]
+        
+        return tf.gather_nd(slot_data, token_index)
+    
+    def _generate_mean(self,
+                       input_data,
+                       input_weight=None):
+        """Generate mean, weighted by input weight if given"""
+        if input_weight is None:
+            return tf.reduce_mean(input_data)
+        
+        return tf.reduce_sum(input_data * input_weight) / tf.maximum(tf.reduce_sum(input_weight), 1.0)
+    
     def _compute_loss(self,
                       label,
                       label_mask,
@@ -861,6 +1766,32 @@ class XLNetModelBuilder(object):
         
         return loss
     
+    def _unpack_features(self,
+                         features):
+        """Unpack features of packed rows, per-slot features of [b,p,...] are flattened into features of examples of [b*p,...].
+        
+        Tokens of different slots are kept from attending to each other by permutation mask, p_mask of each slot masks out
+        tokens of other slots, and empty slots are weighted 0 by example weight.
+        """
+        pack_ids = features["pack_ids"]                                                                                              # [b,l]
+        pack_size = features["pack_weight"].shape.as_list()[-1]
+        perm_mask = tf.to_float(tf.not_equal(tf.expand_dims(pack_ids, axis=-1), tf.expand_dims(pack_ids, axis=1)))         # [b,l] --> [b,l,l]
+        slot_mask = tf.to_float(tf.equal(tf.expand_dims(pack_ids, axis=1), tf.reshape(tf.range(pack_size), [1,-1,1])))      # [b,l] --> [b,p,l]
+        
+        unpacked_features = {}
+        for name in features.keys():
+            if name in ["input_ids", "input_mask", "segment_ids"]:
+                unpacked_features[name] = features[name]
+            elif name == "p_mask":
+                p_mask = 1 - (1 - tf.expand_dims(features[name], axis=1)) * slot_mask                                     # [b,l] --> [b,p,l]
+                unpacked_features[name] = tf.reshape(p_mask, [-1, tf.shape(p_mask)[-1]])                                  # [b,p,l] --> [b*p,l]
+            elif name not in ["pack_ids", "pack_weight"]:
+                unpacked_features[name] = tf.reshape(features[name], [-1] + features[name].shape.as_list()[2:])      # [b,p,...] --> [b*p,...]
+        
+        example_weight = tf.reshape(features["pack_weight"], [-1])                                                           # [b,p] --> [b*p]
+        
+        return unpacked_features, perm_mask, example_weight
+    
     def _create_model(self,
                       is_training,
                       input_ids,
@@ -870,18 +1801,28 @@ class XLNetModelBuilder(object):
                       cls_index,
                       start_positions=None,
                       end_positions=None,
-                      is_impossible=None):
+                      is_impossible=None,
+                      perm_mask=None,
+                      example_weight=None,
+                      pack_ids=None):
         """Creates XLNet-SQuAD model"""
         model = xlnet.XLNetModel(
             xlnet_config=self.model_config,
             run_config=xlnet.create_run_config(is_training, True, FLAGS),
-            input_ids=tf.transpose(input_ids, perm=[1,0]),                                                               # [b,l] --> [l,b]
-            input_mask=tf.transpose(input_mask, perm=[1,0]),                                                             # [b,l] --> [l,b]
-            seg_ids=tf.transpose(segment_ids, perm=[1,0]))                                                               # [b,l] --> [l,b]
+            input_ids=self._generate_time_major(input_ids),                                                              # [b,l] --> [l,b]
+            input_mask=self._generate_time_major(input_mask),                                                            # [b,l] --> [l,b]
+            seg_ids=self._generate_time_major(segment_ids),                                                              # [b,l] --> [l,b]
+            perm_mask=tf.transpose(perm_mask, perm=[1,2,0]) if perm_mask is not None else None)                      # [b,l,l] --> [l,l,b]
         
         initializer = model.get_initializer()
-        seq_len = tf.shape(input_ids)[-1]
-        output_result = tf.transpose(model.get_sequence_output(), perm=[1,0,2])                                      # [l,b,h] --> [b,l,h]
+        seq_len = tf.shape(p_mask)[-1]
+        # If time major, heads are built on [l,b,h] sequence output as is, shapes below are noted as batch major
+        output_result = model.get_sequence_output()                                                                            # [l,b,h]
+        if not self.time_major:
+            output_result = tf.transpose(output_result, perm=[1,0,2])                                                # [l,b,h] --> [b,l,h]
+        if pack_ids is not None:
+            # Heads run on sequence output of packed rows once, only logits and selected features are split into example slots
+            pack_size = tf.shape(cls_index)[0] // tf.shape(pack_ids)[0]
         
         predicts = {}
         with tf.variable_scope("mrc", reuse=tf.AUTO_REUSE):
@@ -893,7 +1834,9 @@ class XLNetModelBuilder(object):
                     use_bias=True, kernel_initializer=initializer, bias_initializer=tf.zeros_initializer,
                     kernel_regularizer=None, bias_regularizer=None, trainable=True, name="start_project")            # [b,l,h] --> [b,l,1]
                 
-                start_result = tf.squeeze(start_result, axis=-1)                                                       # [b,l,1] --> [b,l]
+                start_result = self._generate_batch_major(tf.squeeze(start_result, axis=-1))                           # [b,l,1] --> [b,l]
+                if pack_ids is not None:
+                    start_result = self._generate_slot_data(start_result, pack_size)                                 # [b,l] --> [b*p,l]
                 start_result = self._generate_masked_data(start_result, start_result_mask)                        # [b,l], [b,l] --> [b,l]
                 start_prob = tf.nn.softmax(start_result, axis=-1)                                                                  # [b,l]
                 
@@ -905,9 +1848,13 @@ class XLNetModelBuilder(object):
             with tf.variable_scope("end", reuse=tf.AUTO_REUSE):
                 if is_training:
                     # During training, compute the end logits based on the ground truth of the start position
-                    start_index = self._generate_onehot_label(tf.expand_dims(start_positions, axis=-1), seq_len)         # [b] --> [b,1,l]
-                    feat_result = tf.matmul(start_index, output_result)                                     # [b,1,l], [b,l,h] --> [b,1,h]
-                    feat_result = tf.tile(feat_result, multiples=[1,seq_len,1])                                      # [b,1,h] --> [b,l,h]
+                    if pack_ids is not None:
+                        # Each token of a packed row gets start feature of its own slot, so end logits of all slots come from one pass
+                        feat_result = self._generate_slot_select(start_positions, output_result, pack_size)          # [b*p], [b,l,h] --> [b*p,1,h]
+                        feat_result = self._generate_slot_feature(feat_result, pack_ids)                                 # [b*p,1,h], [b,l] --> [b,l,h]
+                    else:
+                        feat_result = self._generate_sequence_select(tf.expand_dims(start_positions, axis=-1), output_result)    # [b,1], [b,l,h] --> [b,1,h]
+                        feat_result = self._generate_sequence_tile(feat_result, seq_len)                             # [b,1,h] --> [b,l,h]
                     
                     end_result = tf.concat([output_result, feat_result], axis=-1)                          # [b,l,h], [b,l,h] --> [b,l,2h]
                     end_result_mask = 1 - p_mask                                                                                   # [b,l]
@@ -923,15 +1870,16 @@ class XLNetModelBuilder(object):
                         use_bias=True, kernel_initializer=initializer, bias_initializer=tf.zeros_initializer,
                         kernel_regularizer=None, bias_regularizer=None, trainable=True, name="end_project")          # [b,l,h] --> [b,l,1]
                     
-                    end_result = tf.squeeze(end_result, axis=-1)                                                       # [b,l,1] --> [b,l]
+                    end_result = self._generate_batch_major(tf.squeeze(end_result, axis=-1))                           # [b,l,1] --> [b,l]
+                    if pack_ids is not None:
+                        end_result = self._generate_slot_data(end_result, pack_size)                                 # [b,l] --> [b*p,l]
                     end_result = self._generate_masked_data(end_result, end_result_mask)                          # [b,l], [b,l] --> [b,l]
                     end_prob = tf.nn.softmax(end_result, axis=-1)                                                                  # [b,l]
                 else:
                     # During inference, compute the end logits based on beam search
-                    start_index = self._generate_onehot_label(start_top_index, seq_len)                                # [b,k] --> [b,k,l]
-                    feat_result = tf.matmul(start_index, output_result)                                     # [b,k,l], [b,l,h] --> [b,k,h]
+                    feat_result = self._generate_sequence_select(start_top_index, output_result)            # [b,k], [b,l,h] --> [b,k,h]
                     feat_result = tf.expand_dims(feat_result, axis=1)                                              # [b,k,h] --> [b,1,k,h]
-                    feat_result = tf.tile(feat_result, multiples=[1,seq_len,1,1])                                # [b,1,k,h] --> [b,l,k,h]
+                    feat_result = self._generate_sequence_tile(feat_result, seq_len)                             # [b,1,k,h] --> [b,l,k,h]
                     
                     end_result = tf.expand_dims(output_result, axis=-2)                                            # [b,l,h] --> [b,l,1,h]
                     end_result = tf.tile(end_result, multiples=[1,1,FLAGS.start_n_top,1])                        # [b,l,1,h] --> [b,l,k,h]
@@ -950,7 +1898,7 @@ class XLNetModelBuilder(object):
                         use_bias=True, kernel_initializer=initializer, bias_initializer=tf.zeros_initializer,
                         kernel_regularizer=None, bias_regularizer=None, trainable=True, name="end_project")      # [b,l,k,h] --> [b,l,k,1]
                     
-                    end_result = tf.transpose(tf.squeeze(end_result, axis=-1), perm=[0,2,1])                       # [b,l,k,1] --> [b,k,l]
+                    end_result = tf.transpose(self._generate_batch_major(tf.squeeze(end_result, axis=-1)), perm=[0,2,1])    # [b,l,k,1] --> [b,k,l]
                     end_result = self._generate_masked_data(end_result, end_result_mask)                    # [b,k,l], [b,k,l] --> [b,k,l]
                     end_prob = tf.nn.softmax(end_result, axis=-1)                                                                # [b,k,l]
                     
@@ -959,10 +1907,12 @@ class XLNetModelBuilder(object):
                     predicts["end_index"] = end_top_index
             
             with tf.variable_scope("answer", reuse=tf.AUTO_REUSE):
-                cls_index = self._generate_onehot_label(tf.expand_dims(cls_index, axis=-1), seq_len)                     # [b] --> [b,1,l]
-                feat_result = tf.matmul(tf.expand_dims(start_prob, axis=1), output_result)                    # [b,l], [b,l,h] --> [b,1,h]
-                
-                answer_result = tf.matmul(cls_index, output_result)                                         # [b,1,l], [b,l,h] --> [b,1,h]
+                if pack_ids is not None:
+                    feat_result = self._generate_slot_sum(start_prob, output_result, pack_ids, pack_size)        # [b*p,l], [b,l,h] --> [b*p,1,h]
+                    answer_result = self._generate_slot_select(cls_index, output_result, pack_size)              # [b*p], [b,l,h] --> [b*p,1,h]
+                else:
+                    feat_result = self._generate_sequence_sum(start_prob, output_result)                      # [b,l], [b,l,h] --> [b,1,h]
+                    answer_result = self._generate_sequence_select(tf.expand_dims(cls_index, axis=-1), output_result)    # [b,1], [b,l,h] --> [b,1,h]
                 answer_result = tf.squeeze(tf.concat([feat_result, answer_result], axis=-1), axis=1)         # [b,1,h], [b,1,h] --> [b,2h]
                 answer_result_mask = tf.reduce_max(1 - p_mask, axis=-1)                                                    # [b,l] --> [b]
                 
@@ -991,14 +1941,14 @@ class XLNetModelBuilder(object):
                     end_label = end_positions                                                                                        # [b]
                     end_label_mask = tf.reduce_max(1 - p_mask, axis=-1)                                                    # [b,l] --> [b]
                     end_loss = self._compute_loss(end_label, end_label_mask, end_result, end_result_mask)                            # [b]
-                    loss += tf.reduce_mean(start_loss + end_loss) * 0.5
+                    loss += self._generate_mean(start_loss + end_loss, example_weight) * 0.5
                     
                     if is_impossible is not None:
                         answer_label = is_impossible                                                                                 # [b]
                         answer_label_mask = tf.reduce_max(1 - p_mask, axis=-1)                                             # [b,l] --> [b]
                         answer_loss = tf.nn.sigmoid_cross_entropy_with_logits(
                             labels=answer_label * answer_label_mask, logits=answer_result)                                           # [b]
-                        loss += tf.reduce_mean(answer_loss) * 0.5
+                        loss += self._generate_mean(answer_loss, example_weight) * 0.5
         
         return loss, predicts
     
@@ -1015,6 +1965,15 @@ class XLNetModelBuilder(object):
             
             is_training = (mode == tf.estimator.ModeKeys.TRAIN)
             
+            pack_ids = None
+            perm_mask = None
+            example_weight = None
+            if "pack_ids" in features:
+                pack_ids = features["pack_ids"]
+                features, perm_mask, example_weight = self._unpack_features(features)
+            elif "feature_weight" in features:
+                example_weight = features["feature_weight"]
+            
             unique_id = features["unique_id"]
             input_ids = features["input_ids"]
             input_mask = features["input_mask"]
@@ -1032,7 +1991,8 @@ class XLNetModelBuilder(object):
                 is_impossible = None
 
             loss, predicts = self._create_model(is_training, input_ids, input_mask,
-                p_mask, segment_ids, cls_index, start_position, end_position, is_impossible)
+                p_mask, segment_ids, cls_index, start_position, end_position, is_impossible,
+                perm_mask=perm_mask, example_weight=example_weight, pack_ids=pack_ids)
             
             scaffold_fn = model_utils.init_from_checkpoint(FLAGS)
             
@@ -1156,7 +2116,7 @@ class XLNetPredictProcessor(object):
                         if start_index > example_feature.para_length or end_index > example_feature.para_length:
                             continue
                         
-                        if start_index not in example_feature.token2doc_index:
+                        if start_index >= len(example_feature.token2doc_index):
                             continue
                         
                         example_all_predicts.append({
@@ -1229,16 +2189,22 @@ def main(_):
     if not os.path.exists(FLAGS.output_dir):
         os.mkdir(FLAGS.output_dir)
     
+    example_store = None
+    if FLAGS.example_store_dir:
+        example_store = ExampleStore(store_dir=FLAGS.example_store_dir)
+    
     task_name = FLAGS.task_name.lower()
     data_pipeline = SquadPipeline(
         data_dir=FLAGS.data_dir,
-        task_name=task_name)
+        task_name=task_name,
+        example_store=example_store)
     
     model_config = xlnet.XLNetConfig(json_path=FLAGS.model_config_path)
     
     model_builder = XLNetModelBuilder(
         model_config=model_config,
-        use_tpu=FLAGS.use_tpu)
+        use_tpu=FLAGS.use_tpu,
+        time_major=FLAGS.time_major)
     
     model_fn = model_builder.get_model_fn()
     
@@ -1255,29 +2221,66 @@ def main(_):
     
     tokenizer = XLNetTokenizer(
         sp_model_file=FLAGS.spiece_model_file,
-        lower_case=FLAGS.lower_case)
+        lower_case=FLAGS.lower_case,
+        cache_size=FLAGS.tokenizer_cache_size,
+        num_threads=FLAGS.tokenizer_threads)
+    
+    paragraph_store = None
+    if FLAGS.paragraph_store_dir:
+        paragraph_store = ParagraphStore(
+            store_dir=FLAGS.paragraph_store_dir,
+            spiece_model_file=FLAGS.spiece_model_file,
+            lower_case=FLAGS.lower_case,
+            fast_align=FLAGS.fast_align)
     
     example_processor = XLNetExampleProcessor(
         max_seq_length=FLAGS.max_seq_length,
         max_query_length=FLAGS.max_query_length,
         doc_stride=FLAGS.doc_stride,
-        tokenizer=tokenizer)
+        tokenizer=tokenizer,
+        fast_align=FLAGS.fast_align,
+        paragraph_cache_size=FLAGS.paragraph_cache_size,
+        paragraph_store=paragraph_store,
+        num_workers=FLAGS.num_workers,
+        compact_tfrecord=FLAGS.compact_tfrecord,
+        record_compression=FLAGS.record_compression,
+        features_per_record=FLAGS.features_per_record,
+        pack_size=FLAGS.pack_size)
+    
+    feature_cache = FeatureCache(
+        cache_dir=FLAGS.feature_cache_dir or os.path.join(FLAGS.output_dir, "feature_cache"),
+        max_cache_size=int(FLAGS.feature_cache_size * (1 << 30)))
+    
+    feature_options = {
+        "task_name": task_name,
+        "lower_case": FLAGS.lower_case,
+        "fast_align": FLAGS.fast_align,
+        "max_seq_length": FLAGS.max_seq_length,
+        "max_query_length": FLAGS.max_query_length,
+        "doc_stride": FLAGS.doc_stride,
+        "compact_tfrecord": FLAGS.compact_tfrecord,
+        "record_compression": FLAGS.record_compression
+    }
+    
+    compact_vocab = (example_processor.special_vocab_map, example_processor.segment_vocab_map) if FLAGS.compact_tfrecord else None
+    bucket_boundaries = [int(boundary) for boundary in FLAGS.bucket_boundaries] if FLAGS.bucket_boundaries else None
     
     if FLAGS.do_train:
-        train_examples = data_pipeline.get_train_examples()
-        
         tf.logging.info("***** Run training *****")
-        tf.logging.info("  Num examples = %d", len(train_examples))
         tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
         tf.logging.info("  Num steps = %d", FLAGS.train_steps)
         
-        train_record_file = os.path.join(FLAGS.output_dir, "train-{0}.tfrecord".format(task_name))
-        if not os.path.exists(train_record_file) or FLAGS.overwrite_data:
-            train_features = example_processor.convert_examples_to_features(train_examples, True)
-            np.random.shuffle(train_features)
-            example_processor.save_features_as_tfrecord(train_features, train_record_file, True)
+        train_feature_dir = feature_cache.get_entry_dir(data_pipeline.get_train_data_path(), FLAGS.spiece_model_file,
+            dict(feature_options, shard_size=FLAGS.shard_size, random_seed=FLAGS.random_seed,
+                features_per_record=FLAGS.features_per_record, pack_size=FLAGS.pack_size), hash_data=False)
+        train_record_file = os.path.join(train_feature_dir, "train-{0}.tfrecord".format(task_name))
+        train_record_files = example_processor.save_units_as_tfrecord_shards(data_pipeline.iter_train_units, train_record_file, FLAGS.shard_size, FLAGS.overwrite_data, True)
+        feature_cache.evict()
         
-        train_input_fn = XLNetInputBuilder.get_input_fn(train_record_file, FLAGS.max_seq_length, True, True, FLAGS.shuffle_buffer)
+        train_input_fn = XLNetInputBuilder.get_input_fn(train_record_files, FLAGS.max_seq_length, True, True, FLAGS.shuffle_buffer,
+            compact_vocab=compact_vocab, compression_type=FLAGS.record_compression, batch_parse=FLAGS.batch_parse,
+            features_per_record=FLAGS.features_per_record, prefetch_memory=FLAGS.prefetch_memory, bucket_boundaries=bucket_boundaries,
+            pack_size=FLAGS.pack_size, time_major=FLAGS.time_major)
         estimator.train(input_fn=train_input_fn, max_steps=FLAGS.train_steps)
     
     if FLAGS.do_predict:
@@ -1287,16 +2290,24 @@ def main(_):
         tf.logging.info("  Num examples = %d", len(predict_examples))
         tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
         
-        predict_record_file = os.path.join(FLAGS.output_dir, "dev-{0}.tfrecord".format(task_name))
-        predict_pickle_file = os.path.join(FLAGS.output_dir, "dev-{0}.pkl".format(task_name))
-        if not os.path.exists(predict_record_file) or not os.path.exists(predict_pickle_file) or FLAGS.overwrite_data:
+        predict_feature_dir = feature_cache.get_entry_dir(data_pipeline.get_dev_data_path(), FLAGS.spiece_model_file,
+            dict(feature_options, num_predict_shards=FLAGS.num_predict_shards, sort_by_length=bucket_boundaries is not None))
+        predict_record_file = os.path.join(predict_feature_dir, "dev-{0}.tfrecord".format(task_name))
+        predict_pickle_file = os.path.join(predict_feature_dir, "dev-{0}.pkl".format(task_name))
+        predict_manifest_file = "{0}.manifest.json".format(predict_record_file)
+        if not os.path.exists(predict_manifest_file) or not os.path.exists(predict_pickle_file) or FLAGS.overwrite_data:
             predict_features = example_processor.convert_examples_to_features(predict_examples, False)
-            example_processor.save_features_as_tfrecord(predict_features, predict_record_file, False)
+            # Bucketed records are saved in order of length, so that buckets are filled up quickly
+            predict_record_features = sorted(predict_features, key=lambda feature: feature.cls_index) if bucket_boundaries is not None else predict_features
+            example_processor.save_features_as_tfrecord_shards(predict_record_features, predict_record_file, FLAGS.num_predict_shards, False)
             example_processor.save_features_as_pickle(predict_features, predict_pickle_file)
+            feature_cache.evict()
         else:
             predict_features = example_processor.load_features_from_pickle(predict_pickle_file)
         
-        predict_input_fn = XLNetInputBuilder.get_input_fn(predict_record_file, FLAGS.max_seq_length, False, False)
+        predict_input_fn = XLNetInputBuilder.get_input_fn("{0}-?????".format(predict_record_file), FLAGS.max_seq_length, False, False,
+            compact_vocab=compact_vocab, compression_type=FLAGS.record_compression, batch_parse=FLAGS.batch_parse,
+            prefetch_memory=FLAGS.prefetch_memory, bucket_boundaries=bucket_boundaries, time_major=FLAGS.time_major)
         results = estimator.predict(input_fn=predict_input_fn)
         
         predict_results = [OutputResult(
@@ -1308,6 +2319,11 @@ def main(_):
             end_index=result["end_index"].tolist()
         ) for result in results]
         
+        if bucket_boundaries is not None:
+            # Bucketed batches are out of order, results are restored to order of features
+            unique_id_to_result = {predict_result.unique_id: predict_result for predict_result in predict_results}
+            predict_results = [unique_id_to_result[feature.unique_id] for feature in predict_features]
+        
         predict_processor = XLNetPredictProcessor(
             output_dir=FLAGS.output_dir,
             n_best_size=FLAGS.n_best_size,
@@ -1324,7 +2340,7 @@ def main(_):
         if not os.path.exists(FLAGS.export_dir):
             os.mkdir(FLAGS.export_dir)
         
-        serving_input_fn = XLNetInputBuilder.get_serving_input_fn(FLAGS.max_seq_length)
+        serving_input_fn = XLNetInputBuilder.get_serving_input_fn(FLAGS.max_seq_length, FLAGS.time_major)
         estimator.export_savedmodel(FLAGS.export_dir, serving_input_fn, as_text=False)
 
 if __name__ == "__main__":
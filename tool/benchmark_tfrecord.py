@@ -0,0 +1,103 @@
+import argparse
+import gzip
+import os
+import struct
+import time
+import zlib
+
+from tfrecord_writer import TFRecordWriter
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+COMPRESSION_SUFFIXES = {"": "", "GZIP": ".gz", "ZLIB": ".zlib"}
+
+def add_arguments(parser):
+    parser.add_argument("--input_file", help="path to uncompressed TFRecord file", required=True)
+    parser.add_argument("--output_dir", help="path to output directory", required=True)
+    parser.add_argument("--compression_types", help="comma separated compression types, NONE for no compression", required=False, default="NONE,GZIP,ZLIB")
+    parser.add_argument("--num_repeats", help="number of timed reads per compression type", required=False, default=3, type=int)
+
+def read_data(record_file,
+              compression_type):
+    if compression_type == "GZIP":
+        with gzip.open(record_file, "rb") as file:
+            return file.read()
+
+    with open(record_file, "rb") as file:
+        data = file.read()
+
+    return zlib.decompress(data) if compression_type == "ZLIB" else data
+
+def read_records(record_file,
+                 compression_type):
+    data = read_data(record_file, compression_type)
+    records = []
+    offset = 0
+    while offset < len(data):
+        (length,) = struct.unpack("<Q", data[offset:offset+8])
+        records.append(data[offset+12:offset+12+length])
+        offset += length + 16
+
+    return records
+
+def time_tf_read(record_file,
+                 compression_type):
+    with tf.Graph().as_default():
+        dataset = tf.data.TFRecordDataset(record_file, compression_type=compression_type).batch(1024)
+        next_records = dataset.make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            start_time = time.process_time()
+            try:
+                while True:
+                    sess.run(next_records)
+            except tf.errors.OutOfRangeError:
+                pass
+
+            return time.process_time() - start_time
+
+def benchmark_tfrecord(input_file,
+                       output_dir,
+                       compression_types,
+                       num_repeats):
+    records = read_records(input_file, "")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    print("{0} records from {1}".format(len(records), input_file))
+    print("{0:>8} {1:>12} {2:>8} {3:>10} {4:>12} {5:>10}".format("type", "size (MB)", "ratio", "write (s)", "decode (s)", "tf (s)"))
+
+    base_size = None
+    for compression_type in compression_types:
+        record_file = os.path.join(output_dir, "benchmark.tfrecord{0}".format(COMPRESSION_SUFFIXES[compression_type]))
+        start_time = time.process_time()
+        with TFRecordWriter(record_file, compression_type=compression_type) as writer:
+            for record in records:
+                writer.write(record)
+
+        write_time = time.process_time() - start_time
+        file_size = os.path.getsize(record_file)
+        base_size = base_size or file_size
+
+        decode_times = []
+        for _ in range(num_repeats):
+            start_time = time.process_time()
+            decoded_records = read_records(record_file, compression_type)
+            decode_times.append(time.process_time() - start_time)
+
+        assert len(decoded_records) == len(records)
+
+        tf_time = min([time_tf_read(record_file, compression_type) for _ in range(num_repeats)]) if tf is not None else None
+
+        print("{0:>8} {1:>12.2f} {2:>8.2f} {3:>10.3f} {4:>12.3f} {5:>10}".format(compression_type or "NONE",
+            file_size / (1 << 20), base_size / file_size, write_time, min(decode_times),
+            "{0:.3f}".format(tf_time) if tf_time is not None else "n/a"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    compression_types = ["" if compression_type == "NONE" else compression_type for compression_type in args.compression_types.split(",")]
+    benchmark_tfrecord(args.input_file, args.output_dir, compression_types, args.num_repeats)
@@ -0,0 +1,131 @@
+import argparse
+import importlib
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Runners import the xlnet submodule relative to working directory, so this script is run from repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RUNNERS = ["run_squad", "run_coqa", "run_quac", "run_coqa_kd"]
+TIME_MAJOR_FEATURES = ["input_ids", "input_mask", "segment_ids"]
+
+def add_arguments(parser):
+    parser.add_argument("--runner", help="runner whose model is benchmarked", required=False, default="run_squad", choices=RUNNERS)
+    parser.add_argument("--model_config_path", help="path to XLNet model config, a config of model arguments below is used if not given", required=False, default=None)
+    parser.add_argument("--n_layer", help="number of layers", required=False, default=4, type=int)
+    parser.add_argument("--d_model", help="hidden size", required=False, default=512, type=int)
+    parser.add_argument("--n_head", help="number of attention heads", required=False, default=8, type=int)
+    parser.add_argument("--d_head", help="size of attention head", required=False, default=64, type=int)
+    parser.add_argument("--d_inner", help="size of feed-forward inner layer", required=False, default=2048, type=int)
+    parser.add_argument("--n_token", help="vocab size", required=False, default=32000, type=int)
+    parser.add_argument("--seq_length", help="max sequence length", required=False, default=512, type=int)
+    parser.add_argument("--batch_size", help="batch size", required=False, default=4, type=int)
+    parser.add_argument("--modes", help="comma separated modes, train and/or predict", required=False, default="train,predict")
+    parser.add_argument("--num_warmup_steps", help="number of untimed steps per run", required=False, default=2, type=int)
+    parser.add_argument("--num_steps", help="number of timed steps per run", required=False, default=10, type=int)
+
+def get_model_config(runner,
+                     args):
+    if args.model_config_path is not None:
+        return runner.xlnet.XLNetConfig(json_path=args.model_config_path)
+
+    return runner.xlnet.XLNetConfig(FLAGS=argparse.Namespace(n_layer=args.n_layer, d_model=args.d_model, n_head=args.n_head,
+        d_head=args.d_head, d_inner=args.d_inner, ff_activation="gelu", untie_r=True, n_token=args.n_token))
+
+def get_features(seq_length,
+                 batch_size,
+                 n_token,
+                 time_major):
+    """Random batch of features in the layout input function emits, label features of all runners are included."""
+    para_length = seq_length // 2
+    cls_index = seq_length - 1
+    p_mask = np.zeros((batch_size, seq_length), dtype=np.float32)
+    p_mask[:, para_length:cls_index] = 1
+    segment_ids = np.zeros((batch_size, seq_length), dtype=np.int32)
+    segment_ids[:, para_length:] = 1
+    start_position = np.random.randint(para_length, size=batch_size).astype(np.int32)
+
+    features = {
+        "unique_id": np.arange(batch_size, dtype=np.int32),
+        "input_ids": np.random.randint(n_token, size=(batch_size, seq_length)).astype(np.int32),
+        "input_mask": np.zeros((batch_size, seq_length), dtype=np.float32),
+        "p_mask": p_mask,
+        "segment_ids": segment_ids,
+        "cls_index": np.full(batch_size, cls_index, dtype=np.int32),
+        "start_position": start_position,
+        "end_position": np.minimum(start_position + 8, para_length - 1),
+        "start_target": np.full((batch_size, seq_length), 1.0 / seq_length, dtype=np.float32),
+        "end_target": np.full((batch_size, seq_length), 1.0 / seq_length, dtype=np.float32),
+        "number_target": np.full((batch_size, 12), 1.0 / 12, dtype=np.float32),
+        "option_target": np.full((batch_size, 3), 1.0 / 3, dtype=np.float32),
+    }
+
+    for name in ["is_impossible", "is_unk", "is_yes", "is_no", "number", "option", "no_answer", "yes_no", "follow_up",
+                 "unk_target", "yes_target", "no_target"]:
+        features[name] = np.zeros(batch_size, dtype=np.float32)
+
+    if time_major:
+        for name in TIME_MAJOR_FEATURES:
+            features[name] = np.ascontiguousarray(features[name].T)
+
+    return features
+
+def time_model_step(runner,
+                    model_config,
+                    features,
+                    time_major,
+                    is_training,
+                    num_warmup_steps,
+                    num_steps):
+    """Median wall time of a model step on CPU, features are fed as the input function emits them."""
+    with tf.Graph().as_default():
+        tf.set_random_seed(100)
+        placeholders = {name: tf.placeholder(tf.as_dtype(value.dtype), value.shape, name=name) for name, value in features.items()}
+        model_builder = runner.XLNetModelBuilder(model_config=model_config, time_major=time_major)
+        mode = tf.estimator.ModeKeys.TRAIN if is_training else tf.estimator.ModeKeys.PREDICT
+        output_spec = model_builder.get_model_fn()(dict(placeholders), None, mode, {})
+        fetches = output_spec.train_op if is_training else output_spec.predictions
+        feed_dict = {placeholders[name]: value for name, value in features.items()}
+
+        with tf.Session(config=tf.ConfigProto(device_count={"GPU": 0})) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(num_warmup_steps):
+                sess.run(fetches, feed_dict=feed_dict)
+
+            step_times = []
+            for _ in range(num_steps):
+                start_time = time.time()
+                sess.run(fetches, feed_dict=feed_dict)
+                step_times.append(time.time() - start_time)
+
+    return float(np.median(step_times))
+
+def benchmark_time_major(runner_name,
+                         args,
+                         modes):
+    runner = importlib.import_module(runner_name)
+    runner.FLAGS(sys.argv[:1])
+    model_config = get_model_config(runner, args)
+
+    print("{0} on CPU, seq length {1}, batch size {2}, {3} layers of d_model {4}".format(runner_name,
+        args.seq_length, args.batch_size, model_config.n_layer, model_config.d_model))
+    print("{0:>8} {1:>18} {2:>18} {3:>8}".format("mode", "batch major (s)", "time major (s)", "speedup"))
+
+    for mode in modes:
+        step_times = []
+        for time_major in [False, True]:
+            features = get_features(args.seq_length, args.batch_size, model_config.n_token, time_major)
+            step_times.append(time_model_step(runner, model_config, features, time_major, mode == "train",
+                args.num_warmup_steps, args.num_steps))
+
+        print("{0:>8} {1:>18.4f} {2:>18.4f} {3:>8.2f}".format(mode, step_times[0], step_times[1], step_times[0] / step_times[1]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    benchmark_time_major(args.runner, args, args.modes.split(","))
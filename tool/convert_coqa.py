@@ -3,7 +3,7 @@ import json
 
 import numpy as np
 
-from eval_coqa import CoQAEvaluator
+from text_utils import normalize_answer
 
 def add_arguments(parser):
     parser.add_argument("--input_file", help="path to input file", required=True)
@@ -33,7 +33,7 @@ def convert_coqa(input_file,
                 answer = answer_list[data["num_id"]-1]
             elif answer == "option":
                 answer = data["predict_text"]
-                norm_question_tokens = CoQAEvaluator.normalize_answer(data["question_text"]).split(" ")
+                norm_question_tokens = normalize_answer(data["question_text"]).split(" ")
                 if "or" in norm_question_tokens:
                     index = norm_question_tokens.index("or")
                     if index-1 >= 0 and index+1 < len(norm_question_tokens):
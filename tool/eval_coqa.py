@@ -4,12 +4,15 @@ The code is based partially on SQuAD 2.0 evaluation script.
 """
 import argparse
 import json
-import re
-import string
 import sys
 
 from collections import Counter, OrderedDict
 
+try:
+    from . import text_utils
+except ImportError:
+    import text_utils
+
 OPTS = None
 
 out_domain = ["reddit", "science"]
@@ -61,22 +64,7 @@ class CoQAEvaluator():
     @staticmethod
     def normalize_answer(s):
         """Lower text and remove punctuation, storys and extra whitespace."""
-
-        def remove_articles(text):
-            regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
-            return re.sub(regex, ' ', text)
-
-        def white_space_fix(text):
-            return ' '.join(text.split())
-
-        def remove_punc(text):
-            exclude = set(string.punctuation)
-            return ''.join(ch for ch in text if ch not in exclude)
-
-        def lower(text):
-            return text.lower()
-
-        return white_space_fix(remove_articles(remove_punc(lower(s))))
+        return text_utils.normalize_answer(s)
 
     @staticmethod
     def get_tokens(s):
@@ -1,23 +1,19 @@
-import json, string, re
+import json
 from collections import Counter, defaultdict
 from argparse import ArgumentParser
 
+try:
+  from . import text_utils
+except ImportError:
+  import text_utils
+
 
 def is_overlapping(x1, x2, y1, y2):
   return max(x1, y1) <= min(x2, y2)
 
 def normalize_answer(s):
   """Lower text and remove punctuation, articles and extra whitespace."""
-  def remove_articles(text):
-    return re.sub(r'\b(a|an|the)\b', ' ', text)
-  def white_space_fix(text):
-    return ' '.join(text.split())
-  def remove_punc(text):
-    exclude = set(string.punctuation)
-    return ''.join(ch for ch in text if ch not in exclude)
-  def lower(text):
-    return text.lower()
-  return white_space_fix(remove_articles(remove_punc(lower(s))))
+  return text_utils.normalize_answer(s)
 
 def f1_score(prediction, ground_truth):
   prediction_tokens = normalize_answer(prediction).split()
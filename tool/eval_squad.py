@@ -10,10 +10,13 @@ import collections
 import json
 import numpy as np
 import os
-import re
-import string
 import sys
 
+try:
+  from . import text_utils
+except ImportError:
+  import text_utils
+
 OPTS = None
 
 def parse_args():
@@ -44,17 +47,7 @@ def make_qid_to_has_ans(dataset):
 
 def normalize_answer(s):
   """Lower text and remove punctuation, articles and extra whitespace."""
-  def remove_articles(text):
-    regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
-    return re.sub(regex, ' ', text)
-  def white_space_fix(text):
-    return ' '.join(text.split())
-  def remove_punc(text):
-    exclude = set(string.punctuation)
-    return ''.join(ch for ch in text if ch not in exclude)
-  def lower(text):
-    return text.lower()
-  return white_space_fix(remove_articles(remove_punc(lower(s))))
+  return text_utils.normalize_answer(s)
 
 def get_tokens(s):
   if not s: return []
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+class ExampleStore(object):
+    """Content-addressed on-disk store of processed examples in columnar binary format.
+
+    Each entry is a directory keyed by a hash of data file content and pipeline options, holding .npy arrays of
+    named columns. Text columns are deduplicated into a utf-8 blob with offsets plus per-row indices (-1 for None),
+    json columns are text columns of encoded values, int and bool columns are plain arrays and ints columns (lists
+    of ints) are flat arrays with offsets. Arrays are loaded with mmap, so an entry is decoded without extra copies.
+    """
+    version = 1
+    chunk_size = 1 << 20
+
+    def __init__(self,
+                 store_dir):
+        """Construct example store"""
+        self.store_dir = store_dir
+
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def _get_entry_dir(self,
+                       data_file,
+                       options):
+        fingerprint = hashlib.sha1()
+        with open(data_file, "rb") as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), b""):
+                fingerprint.update(chunk)
+
+        fingerprint.update("|{0}|{1}".format(self.version, json.dumps(options, sort_keys=True)).encode("utf-8"))
+        return os.path.join(self.store_dir, fingerprint.hexdigest())
+
+    def _encode_text(self,
+                     values):
+        text_index = {}
+        indices = np.empty(len(values), dtype=np.int32)
+        for idx, value in enumerate(values):
+            indices[idx] = -1 if value is None else text_index.setdefault(value, len(text_index))
+
+        text_list = [text.encode("utf-8") for text in text_index]
+        offsets = np.zeros(len(text_list) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in text_list])
+        blob = np.frombuffer(b"".join(text_list), dtype=np.uint8)
+        return {"blob": blob, "offsets": offsets, "indices": indices}
+
+    def _decode_text(self,
+                     arrays):
+        blob = memoryview(arrays["blob"])
+        offsets = arrays["offsets"].tolist()
+        text_list = [str(blob[offsets[idx]:offsets[idx+1]], "utf-8") for idx in range(len(offsets) - 1)]
+        return [None if idx < 0 else text_list[idx] for idx in arrays["indices"].tolist()]
+
+    def _encode_column(self,
+                       column_type,
+                       values):
+        if column_type == "text":
+            return self._encode_text(values)
+        elif column_type == "json":
+            return self._encode_text([json.dumps(value) for value in values])
+        elif column_type == "int":
+            return {"values": np.array(values, dtype=np.int64)}
+        elif column_type == "bool":
+            return {"values": np.array(values, dtype=np.bool_)}
+        elif column_type == "ints":
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in values])
+            flat_values = np.array([item for value in values for item in value], dtype=np.int64)
+            return {"values": flat_values, "offsets": offsets}
+        else:
+            raise ValueError("unsupported column type {0}".format(column_type))
+
+    def _decode_column(self,
+                       column_type,
+                       arrays):
+        if column_type == "text":
+            return self._decode_text(arrays)
+        elif column_type == "json":
+            return [json.loads(value) for value in self._decode_text(arrays)]
+        elif column_type in ["int", "bool"]:
+            return arrays["values"].tolist()
+        elif column_type == "ints":
+            flat_values = arrays["values"].tolist()
+            offsets = arrays["offsets"].tolist()
+            return [flat_values[offsets[idx]:offsets[idx+1]] for idx in range(len(offsets) - 1)]
+        else:
+            raise ValueError("unsupported column type {0}".format(column_type))
+
+    def load(self,
+             data_file,
+             options):
+        """Load columns of examples processed from data file with given options, return None if not found."""
+        entry_dir = self._get_entry_dir(data_file, options)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path, "r") as file:
+            meta = json.load(file)
+
+        columns = {}
+        for column_name, column_type, array_names in meta["columns"]:
+            arrays = {array_name: np.load(os.path.join(entry_dir, "{0}.{1}.npy".format(column_name, array_name)), mmap_mode="r")
+                for array_name in array_names}
+            columns[column_name] = self._decode_column(column_type, arrays)
+
+        return columns
+
+    def save(self,
+             data_file,
+             options,
+             columns):
+        """Save columns of examples, `columns` is a list of (column_name, column_type, values) tuples.
+
+        Entry is written to a temp directory and renamed, so that concurrent writers and readers are safe.
+        """
+        entry_dir = self._get_entry_dir(data_file, options)
+        if os.path.exists(entry_dir):
+            return
+
+        temp_dir = tempfile.mkdtemp(dir=self.store_dir, suffix=".tmp")
+        meta = {"columns": []}
+        for column_name, column_type, values in columns:
+            arrays = self._encode_column(column_type, values)
+            for array_name, array in arrays.items():
+                np.save(os.path.join(temp_dir, "{0}.{1}.npy".format(column_name, array_name)), array)
+
+            meta["columns"].append([column_name, column_type, sorted(arrays)])
+
+        with open(os.path.join(temp_dir, "meta.json"), "w") as file:
+            json.dump(meta, file)
+
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
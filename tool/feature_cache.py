@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import shutil
+
+class FeatureCache(object):
+    """Content-addressed on-disk cache of converted features with LRU eviction.
+
+    Each entry is a directory keyed by a fingerprint of the input data file, sentence piece model and all
+    preprocessing options, so features converted with different options coexist and stale features are never
+    reused. Entries not used recently are evicted when total size of the cache exceeds its disk budget.
+    Entries of features which track content of data units by themselves (e.g. incrementally converted shards)
+    can be keyed by data file path instead of content, so that they are updated in place when data changes.
+    """
+    version = 1
+    access_file = ".access"
+    chunk_size = 1 << 20
+
+    def __init__(self,
+                 cache_dir,
+                 max_cache_size=None):
+        """Construct feature cache, `max_cache_size` is disk budget in bytes and None means no budget."""
+        self.cache_dir = cache_dir
+        self.max_cache_size = max_cache_size
+        self.active_dirs = set()
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _update_file(self,
+                     fingerprint,
+                     file_path):
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), b""):
+                fingerprint.update(chunk)
+
+    def get_fingerprint(self,
+                        data_file,
+                        spiece_model_file,
+                        options,
+                        hash_data=True):
+        """Get fingerprint of data file content (or path if not `hash_data`), sentence piece model and preprocessing options."""
+        fingerprint = hashlib.sha1()
+        if hash_data:
+            self._update_file(fingerprint, data_file)
+        else:
+            fingerprint.update(os.path.abspath(data_file).encode("utf-8"))
+
+        self._update_file(fingerprint, spiece_model_file)
+        fingerprint.update("|{0}|{1}".format(self.version, json.dumps(options, sort_keys=True)).encode("utf-8"))
+        return fingerprint.hexdigest()
+
+    def get_entry_dir(self,
+                      data_file,
+                      spiece_model_file,
+                      options,
+                      hash_data=True):
+        """Get entry directory of features converted from data file with given options, create it if not found."""
+        entry_dir = os.path.join(self.cache_dir, self.get_fingerprint(data_file, spiece_model_file, options, hash_data))
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir, exist_ok=True)
+
+        with open(os.path.join(entry_dir, self.access_file), "w") as file:
+            json.dump({"data_file": data_file, "options": options}, file)
+
+        self.active_dirs.add(entry_dir)
+        self.evict()
+
+        return entry_dir
+
+    def _get_entry_size(self,
+                        entry_dir):
+        entry_size = 0
+        for folder, _, file_names in os.walk(entry_dir):
+            for file_name in file_names:
+                file_path = os.path.join(folder, file_name)
+                if os.path.isfile(file_path):
+                    entry_size += os.path.getsize(file_path)
+
+        return entry_size
+
+    def evict(self):
+        """Evict least recently used entries until cache fits disk budget, entries used by this process are kept."""
+        if self.max_cache_size is None:
+            return
+
+        entry_list = []
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            access_path = os.path.join(entry_dir, self.access_file)
+            if not os.path.exists(access_path):
+                continue
+
+            entry_list.append((os.path.getmtime(access_path), entry_dir, self._get_entry_size(entry_dir)))
+
+        cache_size = sum([entry_size for _, _, entry_size in entry_list])
+        for _, entry_dir, entry_size in sorted(entry_list):
+            if cache_size <= self.max_cache_size:
+                break
+
+            if entry_dir in self.active_dirs:
+                continue
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            cache_size -= entry_size
@@ -0,0 +1,105 @@
+import gzip
+import json
+
+class JsonStreamReader(object):
+    """Incremental reader for a top-level array field of a JSON file.
+
+    Dataset files are objects like {"version": ..., "data": [...]}, this reader decodes items of the array
+    field one at a time from fixed-size chunks, so memory is bounded by the largest single item instead of
+    the whole file. Files ending with `.gz` are decompressed on the fly.
+    """
+    whitespace = " \t\n\r"
+    delimiters = " \t\n\r,:]}"
+
+    def __init__(self,
+                 data_path,
+                 field_name="data",
+                 chunk_size=1 << 20):
+        """Construct JSON stream reader"""
+        self.data_path = data_path
+        self.field_name = field_name
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+
+    def _open(self):
+        if self.data_path.endswith(".gz"):
+            return gzip.open(self.data_path, "rt", encoding="utf-8")
+
+        return open(self.data_path, "r", encoding="utf-8")
+
+    def _read(self):
+        """Append next chunk to buffer, read size grows with buffer so that large items are decoded in linear time."""
+        chunk = self.file.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def _peek(self):
+        """Skip whitespace and get next char, return None at end of file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if self.eof:
+                return None
+
+            self._read()
+
+    def _expect(self,
+                chars):
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError("invalid JSON in {0}: expect one of '{1}' but found '{2}' at position {3}".format(
+                self.data_path, chars, char, self.pos))
+
+        self.pos += 1
+        return char
+
+    def _decode(self):
+        """Decode next value, which is accepted only if it's followed by a delimiter or at end of file, as a number may be cut by chunk."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if (end < len(self.buffer) and self.buffer[end] in self.delimiters) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self._read()
+
+    def __iter__(self):
+        with self._open() as self.file:
+            self.buffer = ""
+            self.pos = 0
+            self.eof = False
+
+            self._expect("{")
+            if self._peek() == "}":
+                return
+
+            while True:
+                key = self._decode()
+                self._expect(":")
+                if key != self.field_name:
+                    self._decode()
+                else:
+                    self._expect("[")
+                    if self._peek() == "]":
+                        self.pos += 1
+                    else:
+                        while True:
+                            yield self._decode()
+                            if self._expect(",]") == "]":
+                                break
+
+                if self._expect(",}") == "}":
+                    break
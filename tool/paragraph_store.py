@@ -0,0 +1,110 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+class ParagraphStore(object):
+    """Content-addressed on-disk store of converted paragraphs.
+
+    Each entry is a single int32 .npy file holding tokenized pieces, piece ids and char index mappings
+    (-1 for unmatched chars) of one paragraph, keyed by a hash of paragraph text, sentence piece model
+    and preprocessing options. Entries are memory-mapped on load and each field is copied out as a small
+    array, so returned arrays don't keep the mapping open.
+    Entries only depend on paragraph-level preprocessing, so they can be shared by all runners and reused
+    when window-level options (e.g. max_seq_length, doc_stride, num_turn) change.
+    """
+    version = 1
+
+    def __init__(self,
+                 store_dir,
+                 spiece_model_file,
+                 lower_case=False,
+                 fast_align=False):
+        """Construct paragraph store"""
+        self.store_dir = store_dir
+
+        fingerprint = hashlib.sha1()
+        with open(spiece_model_file, "rb") as file:
+            fingerprint.update(file.read())
+
+        fingerprint.update("|{0}|{1}|{2}".format(self.version, lower_case, fast_align).encode("utf-8"))
+        self.fingerprint = fingerprint.hexdigest()
+
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def _get_path(self,
+                  para_text):
+        key = hashlib.sha1("{0}|{1}".format(self.fingerprint, para_text).encode("utf-8")).hexdigest()
+        return os.path.join(self.store_dir, key[:2], "{0}.npy".format(key))
+
+    def get(self,
+            para_text):
+        """Get converted paragraph from store, return None if not found."""
+        store_path = self._get_path(para_text)
+        if not os.path.exists(store_path):
+            return None
+
+        data = np.load(store_path, mmap_mode="r")
+        _, num_token, num_raw_char, num_tokenized_char, mismatch = data[:5].tolist()
+
+        offset = 5
+        def _next(size):
+            nonlocal offset
+            array = np.array(data[offset:offset+size])
+            offset += size
+            return array
+
+        piece_lengths = _next(num_token)
+        piece_ids = _next(num_token)
+        piece_chars = _next(num_tokenized_char)
+        char2token_index = _next(num_tokenized_char)
+        raw2tokenized_char_index = _next(num_raw_char)
+        token2char_raw_start_index = _next(num_token)
+        token2char_raw_end_index = _next(num_token)
+
+        tokenized_para_text = np.asarray(piece_chars, dtype="<u4").tobytes().decode("utf-32-le")
+        piece_ends = np.cumsum(piece_lengths).tolist()
+        piece_starts = [0] + piece_ends[:-1]
+        para_tokens = [tokenized_para_text[start:end] for start, end in zip(piece_starts, piece_ends)]
+
+        return {
+            "para_tokens": para_tokens,
+            "para_ids": piece_ids,
+            "char2token_index": char2token_index,
+            "raw2tokenized_char_index": raw2tokenized_char_index,
+            "token2char_raw_start_index": token2char_raw_start_index,
+            "token2char_raw_end_index": token2char_raw_end_index,
+            "mismatch": bool(mismatch)
+        }
+
+    def put(self,
+            para_text,
+            paragraph):
+        """Put converted paragraph into store, written atomically so that concurrent writers are safe."""
+        store_path = self._get_path(para_text)
+        if os.path.exists(store_path):
+            return
+
+        tokenized_para_text = "".join(paragraph["para_tokens"])
+        data = np.concatenate([
+            np.array([self.version, len(paragraph["para_tokens"]), len(paragraph["raw2tokenized_char_index"]),
+                len(tokenized_para_text), int(paragraph["mismatch"])], dtype=np.int32),
+            np.array([len(token) for token in paragraph["para_tokens"]], dtype=np.int32),
+            np.array(paragraph["para_ids"], dtype=np.int32),
+            np.frombuffer(tokenized_para_text.encode("utf-32-le"), dtype="<u4").astype(np.int32),
+            np.asarray(paragraph["char2token_index"], dtype=np.int32),
+            np.asarray(paragraph["raw2tokenized_char_index"], dtype=np.int32),
+            np.asarray(paragraph["token2char_raw_start_index"], dtype=np.int32),
+            np.asarray(paragraph["token2char_raw_end_index"], dtype=np.int32)])
+
+        store_folder = os.path.dirname(store_path)
+        if not os.path.exists(store_folder):
+            os.makedirs(store_folder, exist_ok=True)
+
+        file_handle, temp_path = tempfile.mkstemp(dir=store_folder, suffix=".tmp")
+        with os.fdopen(file_handle, "wb") as file:
+            np.save(file, data)
+
+        os.replace(temp_path, store_path)
@@ -0,0 +1,30 @@
+import functools
+import re
+import string
+
+ARTICLE_REGEX = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+BATCH_SEPARATOR = '\x00'
+
+@functools.lru_cache(maxsize=1 << 18)
+def normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace."""
+    text = s.lower().translate(PUNCTUATION_TABLE)
+    text = ARTICLE_REGEX.sub(' ', text)
+    return ' '.join(text.split())
+
+def normalize_answers(s_list):
+    """Normalize a list of texts in one pass, same as calling `normalize_answer` on each text.
+
+    Texts are joined by a separator which is neither a word char nor whitespace, so that lowering,
+    punctuation removal and article removal see the same boundaries as on each single text.
+    """
+    if not s_list:
+        return []
+
+    if any(BATCH_SEPARATOR in s for s in s_list):
+        return [normalize_answer(s) for s in s_list]
+
+    text = BATCH_SEPARATOR.join(s_list).lower().translate(PUNCTUATION_TABLE)
+    text = ARTICLE_REGEX.sub(' ', text)
+    return [' '.join(norm_text.split()) for norm_text in text.split(BATCH_SEPARATOR)]
@@ -0,0 +1,226 @@
+import gzip
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+CRC32C_POLY = 0x82F63B78
+CRC32C_MASK_DELTA = 0xA282EAD8
+VARINT_SHIFTS = np.arange(0, 70, 7, dtype=np.uint64)
+
+def _get_crc32c_table():
+    table = []
+    for idx in range(256):
+        crc = idx
+        for _ in range(8):
+            crc = (crc >> 1) ^ CRC32C_POLY if crc & 1 else crc >> 1
+        table.append(crc)
+
+    return table
+
+CRC32C_TABLE = _get_crc32c_table()
+CRC32C_TABLE_ARRAY = np.array(CRC32C_TABLE, dtype=np.uint32)
+
+def get_crc32c(data):
+    """CRC32C (Castagnoli) checksum of bytes, `crc32c` package is used if installed."""
+    if crc32c is not None:
+        return crc32c.crc32c(data)
+
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+
+    return crc ^ 0xFFFFFFFF
+
+def get_crc32c_batch(data_list):
+    """CRC32C checksums of a list of bytes. Without `crc32c` package, bytes are processed as lanes of a NumPy array,
+    one position of all (sorted by length) bytes per step, which is much faster than the byte-wise loop."""
+    if crc32c is not None or len(data_list) < 2:
+        return [get_crc32c(data) for data in data_list]
+
+    lengths = np.array([len(data) for data in data_list], dtype=np.int64)
+    order = np.argsort(-lengths, kind="stable")
+    sorted_lengths = lengths[order].tolist()
+    lanes = np.zeros((sorted_lengths[0], len(data_list)), dtype=np.uint8)
+    for lane_idx, data_idx in enumerate(order.tolist()):
+        lanes[:sorted_lengths[lane_idx], lane_idx] = np.frombuffer(data_list[data_idx], dtype=np.uint8)
+
+    crcs = np.full(len(data_list), 0xFFFFFFFF, dtype=np.uint32)
+    num_active = len(data_list)
+    for pos in range(sorted_lengths[0]):
+        while sorted_lengths[num_active-1] <= pos:
+            num_active -= 1
+
+        active_crcs = crcs[:num_active]
+        crcs[:num_active] = CRC32C_TABLE_ARRAY[(active_crcs ^ lanes[pos, :num_active]) & 0xFF] ^ (active_crcs >> 8)
+
+    batch_crcs = np.empty(len(data_list), dtype=np.uint32)
+    batch_crcs[order] = crcs ^ 0xFFFFFFFF
+    return batch_crcs.tolist()
+
+def mask_crc32c(crc):
+    """Mask CRC32C checksum as TFRecord framing does."""
+    return ((((crc >> 15) | (crc << 17)) & 0xFFFFFFFF) + CRC32C_MASK_DELTA) & 0xFFFFFFFF
+
+def _encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    data.append(value)
+    return bytes(data)
+
+def _encode_varints(values):
+    """Encode int64 values as protobuf varints, negative values take 10 bytes as two's complement."""
+    values = np.asarray(values).astype(np.int64).reshape(-1).view(np.uint64)
+    if values.size == 0:
+        return b""
+
+    if values.max() < 0x80:
+        return values.astype(np.uint8).tobytes()
+
+    remains = values[:, None] >> VARINT_SHIFTS[None, :]
+    num_bytes = np.maximum((remains != 0).sum(axis=1), 1)
+    is_used = np.arange(len(VARINT_SHIFTS))[None, :] < num_bytes[:, None]
+    has_more = np.arange(len(VARINT_SHIFTS))[None, :] < (num_bytes - 1)[:, None]
+    varint_bytes = (remains & 0x7F) | (has_more.astype(np.uint64) << 7)
+    return varint_bytes[is_used].astype(np.uint8).tobytes()
+
+def _encode_field(field_number,
+                  data):
+    return _encode_varint((field_number << 3) | 2) + _encode_varint(len(data)) + data
+
+def _encode_packed_list(data):
+    return _encode_field(1, data) if data else b""
+
+def encode_int_feature(values):
+    """Encode int values as serialized `tf.train.Feature` with int64_list."""
+    return _encode_field(3, _encode_packed_list(_encode_varints(values)))
+
+def encode_float_feature(values):
+    """Encode float values as serialized `tf.train.Feature` with float_list."""
+    return _encode_field(2, _encode_packed_list(np.asarray(values, dtype="<f4").tobytes()))
+
+def encode_bytes_feature(values):
+    """Encode list of bytes as serialized `tf.train.Feature` with bytes_list."""
+    return _encode_field(1, b"".join([_encode_field(1, value) for value in values]))
+
+def _decode_varint(data,
+                   offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+def _decode_field(data):
+    key, offset = _decode_varint(data, 0)
+    length, offset = _decode_varint(data, offset)
+    return key >> 3, data[offset:offset+length]
+
+def concat_features(feature_list):
+    """Concatenate serialized `tf.train.Feature`s of the same kind (as encoded by `encode_*_feature`) into one,
+    values are concatenated in order."""
+    kind = None
+    data_list = []
+    for feature in feature_list:
+        kind, value_list = _decode_field(feature)
+        if kind == 1:
+            data_list.append(value_list)
+        elif value_list:
+            data_list.append(_decode_field(value_list)[1])
+
+    data = b"".join(data_list)
+    return _encode_field(kind, data if kind == 1 else _encode_packed_list(data))
+
+def encode_example(features):
+    """Encode a dict of serialized features as serialized `tf.train.Example`, map entries are sorted by key
+    as protobuf deterministic serialization does."""
+    entries = [_encode_field(1, _encode_field(1, name.encode("utf-8")) + _encode_field(2, feature))
+        for name, feature in sorted(features.items())]
+    return _encode_field(1, b"".join(entries))
+
+def encode_batched_example(features_list):
+    """Encode dicts of serialized features of several examples as one serialized `tf.train.Example`, values of
+    each feature are concatenated in order of examples, so that a feature of shape [N] is read as shape [K, N]."""
+    if len(features_list) == 1:
+        return encode_example(features_list[0])
+
+    return encode_example({name: concat_features([features[name] for features in features_list]) for name in features_list[0]})
+
+class TFRecordWriter(object):
+    """TFRecord writer which writes the same framing as `tf.python_io.TFRecordWriter` without TensorFlow.
+
+    Each record is framed by length, masked CRC32C of length, data and masked CRC32C of data. Records are buffered
+    and checksummed in batches. As with `tf.python_io.TFRecordOptions`, the whole file can be compressed as GZIP or
+    ZLIB stream, which is read by `tf.data.TFRecordDataset` with the same `compression_type`.
+    """
+    compression_types = ["", "GZIP", "ZLIB"]
+
+    def __init__(self,
+                 path,
+                 batch_size=1024,
+                 compression_type=""):
+        """Construct TFRecord writer"""
+        if compression_type not in self.compression_types:
+            raise ValueError("unsupported compression type {0}".format(compression_type))
+
+        self.compression_type = compression_type
+        self.file = gzip.open(path, "wb") if compression_type == "GZIP" else open(path, "wb")
+        self.compressor = zlib.compressobj() if compression_type == "ZLIB" else None
+        self.batch_size = batch_size
+        self.records = []
+
+    def write(self,
+              record):
+        """Write a record of serialized bytes."""
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Checksum buffered records and write them to file."""
+        if not self.records:
+            return
+
+        headers = [struct.pack("<Q", len(record)) for record in self.records]
+        header_crcs = get_crc32c_batch(headers)
+        record_crcs = get_crc32c_batch(self.records)
+        data = []
+        for header, header_crc, record, record_crc in zip(headers, header_crcs, self.records, record_crcs):
+            data.append(header)
+            data.append(struct.pack("<I", mask_crc32c(header_crc)))
+            data.append(record)
+            data.append(struct.pack("<I", mask_crc32c(record_crc)))
+
+        data = b"".join(data)
+        self.file.write(self.compressor.compress(data) if self.compressor is not None else data)
+        self.records = []
+        if not self.compression_type:
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,
+                 exc_type,
+                 exc_value,
+                 traceback):
+        self.close()